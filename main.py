@@ -7,20 +7,450 @@ with anonymous access for Windows Guest OS connection.
 
 import os
 import sys
+import errno
+import argparse
 import subprocess
 import shutil
 import time
 import select
+import selectors
+import string
 import datetime
+import platform
+import threading
+import concurrent.futures
+import json
+import mmap
+import re
+import shlex
+import functools
+import hashlib
+import socket
+import ctypes
+import ipaddress
+import pwd
+import grp
+
+try:
+    import psutil  # Optional: in-process interface enumeration
+except ImportError:
+    psutil = None
+
+try:
+    import netifaces  # Optional: in-process interface enumeration
+except ImportError:
+    netifaces = None
+
+try:
+    import inotify_simple  # Optional: file change notifications for log monitoring
+except ImportError:
+    inotify_simple = None
+
+try:
+    import selinux  # Optional: libselinux bindings, avoids spawning getenforce
+except ImportError:
+    selinux = None
+
+try:
+    # libc is already mapped into the process; find_library("c") would fork ldconfig
+    _libc = ctypes.CDLL(None, use_errno=True)
+except OSError:
+    _libc = None
 
 # Global configuration variables
 NETWORK_PATH = "/srv/shared"
+SMB_PROTOCOLS = ("NT1", "SMB2", "SMB3")  # Oldest to newest
+PACKAGE_INDEX_MAX_AGE = 3600  # Seconds before the package index is refreshed again
+SMB_SOCKET_BUFFER = 131072  # SO_RCVBUF/SO_SNDBUF in smb.conf
+SMB_LARGE_SOCKET_BUFFER = 16777216  # With --tune-large-buffers; costs RAM per connection
+PROBE_CACHE_FILE = "/var/cache/smb-autosetup/probes.json"
+PROBE_CACHE_TTL = 3600  # Seconds a cached probe result stays valid across runs
+PROBE_CACHE_VERSION = 2  # Bump when the shape of a cached probe result changes
+STATE_FILE = "/var/lib/smb-autosetup/state.json"  # Inputs of the last completed setup
+# Interface name prefixes hidden from the binding menu (container/virtual devices)
+INTERFACE_DENY_PREFIXES = ("lo", "docker", "veth", "br-")
+IFF_UP = 0x1  # Interface administratively up (see netdevice(7))
+IN_MODIFY = 0x2  # File was modified (see inotify(7))
+# Matches the interface header and inet lines of `ip -4 addr show`
+_IP_ADDR_LINE_RE = re.compile(
+    r"^\s*(?:\d+:\s+(?P<name>[^:@\s]+)[^:]*:\s+<(?P<flags>[^>]*)>"
+    r"|inet\s+(?P<ip>\d+\.\d+\.\d+\.\d+)/(?P<prefix>\d+))", re.ASCII)
+# firewall-cmd flags opening Samba, with explicit ports as backup for the service
+SAMBA_FIREWALLD_ARGS = ("--add-service=samba", "--add-port=445/tcp", "--add-port=139/tcp",
+                        "--add-port=137/udp", "--add-port=138/udp")
+# Matches the log level line rewritten by --debug
+_LOG_LEVEL_RE = re.compile(r"log level = \d+", re.ASCII)
+# Matches any of the SMB/NetBIOS ports in `ss` output, in one pass per line
+_SMB_PORT_RE = re.compile(r":(?:445|139|137|138)(?!\d)", re.ASCII)
+# Matches destination ports in `iptables -L -n` output: "dpt:445",
+# "dpts:137:138" and "multiport dports 139,445"
+_IPTABLES_DPORTS_RE = re.compile(r"\b(?:dpts?:|dports )([\d,:]+)", re.ASCII)
+# Matches the "(default, active)" style annotation after a zone name
+_FIREWALLD_ZONE_MARKER_RE = re.compile(r"^(\S+)\s+\([^)]*\)$")
+_DEBUG_LOG_OPTIONS = "\n    debug timestamp = yes\n    debug uid = yes\n    debug pid = yes"
+# os-release ID/ID_LIKE values and the distribution family they map to
+OS_RELEASE_FAMILIES = {
+    "debian": "debian", "ubuntu": "debian",
+    "centos": "centos", "rhel": "redhat", "fedora": "redhat",
+    "arch": "arch",
+    "suse": "suse", "opensuse": "suse",
+}
+# Release marker files in /etc, checked when os-release is unavailable
+ETC_RELEASE_FAMILIES = (
+    ("debian_version", "debian"),
+    ("redhat-release", "redhat"), ("fedora-release", "redhat"),
+    ("centos-release", "centos"),
+    ("arch-release", "arch"),
+    ("SUSE-brand", "suse"), ("SuSE-release", "suse"),
+)
+# Files whose modification invalidates all cached probe results
+PROBE_CACHE_WATCHED_FILES = ("/etc/os-release", "/etc/passwd", "/etc/group")
+
+# smb.conf layout; only the $-placeholders vary between runs
+_SMB_CONF_TEMPLATE = string.Template("""# Samba configuration for anonymous access
+# Global settings
+[global]
+    workgroup = WORKGROUP
+    server string = SMB Server for File Sharing
+    netbios name = SMBSERVER
+    security = user
+    map to guest = bad user
+    guest account = $nobody_user
+    
+    # Network binding
+    interfaces = $interface
+    bind interfaces only = yes
+    
+    # Disable printing
+    load printers = no
+    printing = bsd
+    printcap name = /dev/null
+    disable spoolss = yes
+    
+    # Performance and compatibility (tuned defaults, adjust for your hardware)
+    socket options = TCP_NODELAY IPTOS_LOWDELAY SO_RCVBUF=$socket_buffer SO_SNDBUF=$socket_buffer
+    min receivefile size = 16384
+    use sendfile = yes
+    aio read size = $aio_read_size
+    aio write size = 0
+    aio max threads = 2$multichannel_options
+    min protocol = $min_protocol
+    max protocol = $max_protocol
+    
+    # Logging
+    log file = /var/log/samba/log.%m
+    max log size = 1000
+    log level = 1
+
+# Anonymous share for shared directory
+[$share_name]
+    comment = Shared Directory (Anonymous Access)
+    path = $share_path
+    browseable = yes
+    writable = yes
+    guest ok = yes
+    guest only = yes
+    create mask = 0777
+    directory mask = 0777
+    force create mode = 0777
+    force directory mode = 0777
+    public = yes
+""")
+
+
+_PROBE_CACHE_LOCK = threading.Lock()
+
+
+def _probe_cache_fingerprint():
+    """Return the mtimes of the files that invalidate cached probes"""
+    fingerprint = {"version": PROBE_CACHE_VERSION}
+    for path in PROBE_CACHE_WATCHED_FILES:
+        try:
+            fingerprint[path] = os.path.getmtime(path)
+        except OSError:
+            fingerprint[path] = None
+    return fingerprint
+
+
+def _load_probe_cache():
+    """Load cached probe results, discarding them if the environment changed"""
+    try:
+        with open(PROBE_CACHE_FILE, 'r') as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if not isinstance(cache, dict) or cache.get("fingerprint") != _probe_cache_fingerprint():
+        return {}
+    return cache
+
+
+def _store_probe_cache(cache):
+    """Persist probe results; failures (e.g. not running as root) are ignored"""
+    cache["fingerprint"] = _probe_cache_fingerprint()
+    try:
+        os.makedirs(os.path.dirname(PROBE_CACHE_FILE), mode=0o700, exist_ok=True)
+        tmp_path = f"{PROBE_CACHE_FILE}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(cache, f)
+        os.replace(tmp_path, PROBE_CACHE_FILE)
+    except OSError:
+        pass
+
+
+def _file_digest(path):
+    """Return the blake2b hex digest of a file's contents, or None if unreadable"""
+    try:
+        with open(path, 'rb') as f:
+            return hashlib.blake2b(f.read(), digest_size=16).hexdigest()
+    except OSError:
+        return None
+
+
+def clear_probe_cache():
+    """Remove all cached probe results"""
+    try:
+        os.remove(PROBE_CACHE_FILE)
+    except OSError:
+        pass
+
+
+def disk_cached(key, ttl=PROBE_CACHE_TTL):
+    """Cache a probe method's JSON-serializable result on disk across runs.
+
+    Empty results are never stored, nor is anything stored in a dry run. The
+    cache is bypassed when the instance has use_probe_cache disabled, and
+    refresh=True forces a new probe.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(self, refresh=False):
+            if not getattr(self, 'use_probe_cache', True):
+                return func(self)
+
+            cache = _load_probe_cache()
+            entry = cache.get("probes", {}).get(key)
+            if not refresh and entry and time.time() - entry.get("time", 0) < ttl:
+                return entry["value"]
+
+            value = func(self)
+            if value and not getattr(self, 'dry_run', False):
+                # Probes may run concurrently; re-read so other keys are kept
+                with _PROBE_CACHE_LOCK:
+                    cache = _load_probe_cache()
+                    cache.setdefault("probes", {})[key] = {"time": time.time(), "value": value}
+                    _store_probe_cache(cache)
+            return value
+        return wrapper
+    return decorator
+
+
+class _SockAddr(ctypes.Structure):
+    """struct sockaddr"""
+    _fields_ = [("sa_family", ctypes.c_ushort),
+                ("sa_data", ctypes.c_ubyte * 14)]
+
+
+class _SockAddrIn(ctypes.Structure):
+    """struct sockaddr_in"""
+    _fields_ = [("sin_family", ctypes.c_ushort),
+                ("sin_port", ctypes.c_uint16),
+                ("sin_addr", ctypes.c_ubyte * 4),
+                ("sin_zero", ctypes.c_ubyte * 8)]
+
+
+class _IfAddrs(ctypes.Structure):
+    """struct ifaddrs (see getifaddrs(3))"""
+
+
+_IfAddrs._fields_ = [("ifa_next", ctypes.POINTER(_IfAddrs)),
+                     ("ifa_name", ctypes.c_char_p),
+                     ("ifa_flags", ctypes.c_uint),
+                     ("ifa_addr", ctypes.POINTER(_SockAddr)),
+                     ("ifa_netmask", ctypes.POINTER(_SockAddr)),
+                     ("ifa_ifu", ctypes.POINTER(_SockAddr)),
+                     ("ifa_data", ctypes.c_void_p)]
+
+
+def read_os_release():
+    """Return the os-release fields as a dict ({} if the file is missing)"""
+    if hasattr(platform, "freedesktop_os_release"):  # Python 3.10+
+        try:
+            return platform.freedesktop_os_release()
+        except OSError:
+            return {}
+    for path in ("/etc/os-release", "/usr/lib/os-release"):
+        try:
+            with open(path) as f:
+                lines = f.read().splitlines()
+        except OSError:
+            continue
+        info = {}
+        for line in lines:
+            key, sep, value = line.partition("=")
+            if sep and not key.startswith("#"):
+                words = shlex.split(value)
+                info[key.strip()] = words[0] if words else ""
+        return info
+    return {}
+
+
+@functools.lru_cache(maxsize=None)
+def run_query(*argv):
+    """Run a read-only command once and reuse its result for the rest of the run.
+
+    Call run_query.cache_clear() after changing the state being queried.
+    """
+    return subprocess.run(argv, capture_output=True, text=True)
+
+
+def tail_lines(path, n):
+    """Return the last n lines of a file, scanning backwards from its end"""
+    with open(path, 'rb') as f:
+        try:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:  # Empty files cannot be mapped
+            return ""
+    with data:
+        # A trailing newline ends the last line rather than starting a new one
+        pos = len(data) - 1 if data[-1:] == b"\n" else len(data)
+        for _ in range(n):
+            pos = data.rfind(b"\n", 0, pos)
+            if pos < 0:
+                break
+        return data[pos + 1:].decode(errors='replace')
+
+
+class _ThreadOutputBuffer:
+    """Stdout proxy that holds back output from worker tasks until each finishes.
+
+    Used as a context manager around concurrent setup steps so their messages
+    are printed as whole blocks instead of interleaving line by line.
+    """
+
+    def __init__(self):
+        self._stream = None
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._partial = ""  # Unbuffered output not yet ended by a newline
+
+    def __enter__(self):
+        self._stream = sys.stdout
+        sys.stdout = self
+        return self
+
+    def __exit__(self, *exc_info):
+        self.flush()
+        sys.stdout = self._stream
+
+    def __getattr__(self, name):
+        return getattr(self._stream, name)
+
+    def write(self, text):
+        buffer = getattr(self._local, "buffer", None)
+        if buffer is not None:
+            buffer.append(text)
+            return len(text)
+        with self._lock:
+            # print() writes the newline separately; hold back partial lines
+            # so a worker's block can't land in the middle of one
+            head, newline, tail = (self._partial + text).rpartition("\n")
+            self._partial = tail
+            if newline:
+                self._stream.write(head + newline)
+        return len(text)
+
+    def flush(self):
+        if getattr(self._local, "buffer", None) is None:
+            with self._lock:
+                self._stream.write(self._partial)
+                self._partial = ""
+                self._stream.flush()
+
+    def run(self, func, *args):
+        """Call func in the current thread, printing its output once it returns"""
+        self._local.buffer = []
+        try:
+            return func(*args)
+        finally:
+            text = "".join(self._local.buffer)
+            self._local.buffer = None
+            with self._lock:
+                self._stream.write(text)
+                self._stream.flush()
+
+
+class _FileWatcher:
+    """Block until a file is written to, using inotify when available.
+
+    Falls back to one-second polling where inotify is not supported.
+    """
+
+    def __init__(self, path):
+        self._notifier = None
+        self._fd = None
+        self._selector = None
+        try:
+            if inotify_simple is not None:
+                self._notifier = inotify_simple.INotify()
+                self._notifier.add_watch(path, inotify_simple.flags.MODIFY)
+                self._fd = self._notifier.fileno()
+            else:
+                self._fd = self._inotify_fd(path)
+            if self._fd is not None:
+                # epoll on Linux; the fd is drained without blocking after each wakeup
+                os.set_blocking(self._fd, False)
+                self._selector = selectors.DefaultSelector()
+                self._selector.register(self._fd, selectors.EVENT_READ)
+        except OSError:
+            self.close()
+
+    @staticmethod
+    def _inotify_fd(path):
+        """Create an inotify fd watching path via libc, or None if unsupported"""
+        if _libc is None:
+            return None
+        try:
+            fd = _libc.inotify_init1(os.O_CLOEXEC)
+        except AttributeError:
+            return None
+        if fd < 0:
+            return None
+        if _libc.inotify_add_watch(fd, os.fsencode(path), IN_MODIFY) < 0:
+            os.close(fd)
+            return None
+        return fd
+
+    def wait(self, timeout):
+        """Wait up to timeout seconds for a write; returns True if one may have happened"""
+        if self._fd is None:
+            time.sleep(min(timeout, 1))
+            return True
+        if not self._selector.select(timeout):
+            return False
+        try:
+            while os.read(self._fd, 4096):  # Drain the queued events
+                pass
+        except BlockingIOError:
+            pass
+        return True
+
+    def close(self):
+        if self._selector is not None:
+            self._selector.close()
+            self._selector = None
+        if self._notifier is not None:
+            self._notifier.close()
+        elif self._fd is not None:
+            os.close(self._fd)
+        self._notifier = None
+        self._fd = None
 
 
 class SMBServerSetup:
     def __init__(self, share_path=None, debug_mode=False):
         self.share_path = share_path or NETWORK_PATH
         self.share_name = "shared"
+        self.share_unc_hint = f"\\\\<SERVER_IP>\\{self.share_name}"  # Share path shown in hints
         self.samba_config = "/etc/samba/smb.conf"
         self.backup_config = "/etc/samba/smb.conf.backup"
         self.bind_interfaces = None  # Will be set during interface selection
@@ -28,9 +458,45 @@ class SMBServerSetup:
         self.debug_mode = debug_mode
         self.smb_min_protocol = "NT1"  # Default to SMBv1 for compatibility
         self.smb_max_protocol = "SMB3"  # Support up to SMB3
+        self.assume_yes = False  # Skip interactive prompts and use the defaults
+        self.requested_interface = None  # Interface name or IP to bind without prompting
+        self.smb_protocols_fixed = False  # Protocol range given on the command line
+        self.socket_buffer_size = SMB_SOCKET_BUFFER  # Samba socket send/receive buffer
+        self.multichannel = False  # Enable SMB3 multi-channel in smb.conf
+        self.dry_run = False  # Print state-changing commands instead of running them
+        self.force_refresh = False  # Always refresh the package index before installing
+        self.force = False  # Run every setup step even if already configured
+        self.use_probe_cache = True  # Reuse probe results cached by previous runs
+        self.interface_deny_prefixes = INTERFACE_DENY_PREFIXES
+        self._interfaces_cache = None  # Cached result of get_network_interfaces()
+        self._stdin_pending = b""  # Bytes read from stdin but not yet consumed
+        self._os_info_cache = None  # Cached result of detect_os()
+        self._nobody_cache = None  # Cached result of get_nobody_user_group()
+        self._service_names_cache = None  # Cached result of get_samba_service_names()
+        self._firewalld_active_cache = None  # Cached result of _firewalld_is_active()
+        self._msgs = None  # Blocks printed after setup, see _build_messages()
+        self.config_hash = None  # blake2b digest of the generated smb.conf
+        self._config_unchanged = False  # smb.conf already matched the generated config
+        self._validated_hash = None  # Digest of the smb.conf that passed testparm
+
+    def _sh(self, argv, check=True, **kwargs):
+        """Run a state-changing command from an argv list (never via a shell)"""
+        if self.dry_run:
+            self._print_dry_run(argv, kwargs.get("input"))
+            return subprocess.CompletedProcess(argv, 0, "", "")
+        return subprocess.run(argv, check=check, **kwargs)
+
+    def _print_dry_run(self, argv, stdin=None):
+        """Print the command a dry run skips, shell-quoted for copy-paste"""
+        print("+ " + " ".join(shlex.quote(str(arg)) for arg in argv))
+        for line in (stdin or "").splitlines():
+            print(f"+   < {line}")
 
     def check_root_privileges(self):
         """Check if script is running with root privileges"""
+        if os.geteuid() != 0 and self.dry_run:
+            print("ℹ️  Dry run: not running as root, continuing without privileges")
+            return
         if os.geteuid() != 0:
             print("❌ This script requires root privileges to configure Samba.")
             print("Please run with: sudo python3 main.py")
@@ -39,68 +505,230 @@ class SMBServerSetup:
 
     def check_share_directory(self):
         """Check if share directory exists and create if needed"""
-        if not os.path.exists(self.share_path):
+        if self.dry_run and not os.path.isdir(self.share_path):
+            self._print_dry_run(["mkdir", "-p", "-m", "755", self.share_path])
+            return
+        try:
+            # Let mkdir report an existing directory instead of stat-ing first
+            os.makedirs(self.share_path, mode=0o755)
             print(f"📁 Creating share directory: {self.share_path}")
-            try:
-                os.makedirs(self.share_path, mode=0o755, exist_ok=True)
-                print(f"✅ Directory created: {self.share_path}")
-            except Exception as e:
-                print(f"❌ Failed to create directory: {e}")
-                sys.exit(1)
-        else:
+            print(f"✅ Directory created: {self.share_path}")
+        except FileExistsError:
             print(f"✅ Share directory exists: {self.share_path}")
+        except Exception as e:
+            print(f"❌ Failed to create directory: {e}")
+            sys.exit(1)
     
-    def get_network_interfaces(self):
-        """Get available network interfaces with their IP addresses"""
-        interfaces = []
-        
+    def get_network_interfaces(self, refresh=False):
+        """Get available network interfaces with their IP addresses (cached)"""
+        if self._interfaces_cache is None or refresh:
+            self._interfaces_cache = self._probe_network_interfaces()
+        return self._interfaces_cache
+
+    # Not disk_cached: addresses and link state change between runs, and
+    # in-process enumeration is cheap
+    def _probe_network_interfaces(self):
+        """Enumerate IPv4 interfaces, excluding loopback"""
+        # Prefer in-process enumeration, only fork `ip` as a last resort
+        interfaces = self._interfaces_from_psutil()
+        if interfaces is None:
+            interfaces = self._interfaces_from_netifaces()
+        if interfaces is None:
+            interfaces = self._interfaces_from_getifaddrs()
+        if interfaces is not None:
+            return interfaces
+
+        # Last resort: fork `ip`
         try:
-            # Use ip command to get interface information
-            result = subprocess.run(["ip", "-4", "addr", "show"], 
+            # Use ip's JSON output to get interface information
+            result = subprocess.run(["ip", "-j", "-4", "addr", "show"],
                                   capture_output=True, text=True, check=True)
-            
-            current_interface = None
-            for line in result.stdout.split('\n'):
-                line = line.strip()
-                
-                # Look for interface lines (start with number)
-                if line and line[0].isdigit() and ':' in line:
-                    parts = line.split(':')
-                    if len(parts) >= 2:
-                        current_interface = parts[1].strip()
-                
-                # Look for IP addresses
-                elif line.startswith('inet ') and current_interface:
-                    inet_parts = line.split()
-                    if len(inet_parts) >= 2:
-                        ip_cidr = inet_parts[1]
-                        ip_addr = ip_cidr.split('/')[0]
-                        
-                        # Skip loopback
-                        if not ip_addr.startswith('127.'):
-                            interfaces.append({
-                                'name': current_interface,
-                                'ip': ip_addr,
-                                'cidr': ip_cidr
-                            })
-            
-        except subprocess.CalledProcessError:
-            # Fallback: try using hostname command
+            data = json.loads(result.stdout)
+            interfaces = [
+                {
+                    'name': iface['ifname'],
+                    'ip': addr['local'],
+                    'cidr': f"{addr['local']}/{addr['prefixlen']}"
+                }
+                for iface in data
+                if self._interface_allowed(iface['ifname'], 'UP' in iface.get('flags', []))
+                for addr in iface.get('addr_info', [])
+                # Skip loopback
+                if addr.get('family') == 'inet' and not addr['local'].startswith('127.')
+            ]
+        except (subprocess.CalledProcessError, json.JSONDecodeError, KeyError, TypeError):
+            # Older iproute2 without -j support: parse the text output
             try:
-                result = subprocess.run(["hostname", "-I"], 
+                result = subprocess.run(["ip", "-4", "addr", "show"], 
                                       capture_output=True, text=True, check=True)
-                ips = result.stdout.strip().split()
-                for i, ip in enumerate(ips):
-                    if not ip.startswith('127.'):
-                        interfaces.append({
-                            'name': f'interface{i+1}',
-                            'ip': ip,
-                            'cidr': f'{ip}/24'
-                        })
-            except subprocess.CalledProcessError:
-                pass
+                interfaces = self._parse_ip_addr_output(result.stdout)
+            except (subprocess.CalledProcessError, FileNotFoundError):
+                interfaces = []
+        except FileNotFoundError:
+            interfaces = []
         
         return interfaces
+
+    def _interface_allowed(self, name, is_up):
+        """Check whether an interface should be offered for binding"""
+        return bool(is_up) and not name.startswith(tuple(self.interface_deny_prefixes))
+
+    def _sysfs_up_interfaces(self):
+        """Names of administratively up interfaces from sysfs, or None if unavailable"""
+        up_interfaces = set()
+        try:
+            with os.scandir("/sys/class/net") as it:
+                for entry in it:
+                    try:
+                        with open(os.path.join(entry.path, "flags")) as f:
+                            if int(f.read().strip(), 16) & IFF_UP:
+                                up_interfaces.add(entry.name)
+                    except (OSError, ValueError):
+                        continue
+        except OSError:
+            return None
+        return up_interfaces
+
+    def _interfaces_from_psutil(self):
+        """Enumerate IPv4 interfaces via psutil, or None if unavailable"""
+        if psutil is None:
+            return None
+
+        interfaces = []
+        up_interfaces = self._sysfs_up_interfaces()
+        try:
+            stats = psutil.net_if_stats()
+            for name, addrs in psutil.net_if_addrs().items():
+                # isup means "running" (carrier), which an idle bridge such as
+                # virbr0 lacks; use IFF_UP like the other backends
+                if name in stats and hasattr(stats[name], 'flags'):
+                    is_up = 'up' in stats[name].flags.split(',')
+                elif up_interfaces is not None:
+                    is_up = name in up_interfaces
+                else:
+                    is_up = name in stats and stats[name].isup
+                if not self._interface_allowed(name, is_up):
+                    continue
+                for addr in addrs:
+                    # Skip loopback
+                    if addr.family != socket.AF_INET or addr.address.startswith('127.'):
+                        continue
+                    netmask = addr.netmask or '255.255.255.0'
+                    prefix = ipaddress.IPv4Network(f"{addr.address}/{netmask}", strict=False).prefixlen
+                    interfaces.append({
+                        'name': name,
+                        'ip': addr.address,
+                        'cidr': f"{addr.address}/{prefix}"
+                    })
+        except (ValueError, OSError):
+            return None
+        return interfaces
+
+    def _interfaces_from_netifaces(self):
+        """Enumerate IPv4 interfaces via netifaces, or None if unavailable"""
+        if netifaces is None:
+            return None
+
+        interfaces = []
+        up_interfaces = self._sysfs_up_interfaces()
+        try:
+            for name in netifaces.interfaces():
+                if not self._interface_allowed(name, up_interfaces is None or name in up_interfaces):
+                    continue
+                for addr in netifaces.ifaddresses(name).get(netifaces.AF_INET, []):
+                    ip_addr = addr.get('addr')
+                    # Skip loopback
+                    if not ip_addr or ip_addr.startswith('127.'):
+                        continue
+                    netmask = addr.get('netmask') or '255.255.255.0'
+                    prefix = ipaddress.IPv4Network(f"{ip_addr}/{netmask}", strict=False).prefixlen
+                    interfaces.append({
+                        'name': name,
+                        'ip': ip_addr,
+                        'cidr': f"{ip_addr}/{prefix}"
+                    })
+        except (ValueError, OSError):
+            return None
+        return interfaces
+
+    def _interfaces_from_getifaddrs(self):
+        """Enumerate IPv4 interfaces via libc getifaddrs(3), or None on failure"""
+        if _libc is None:
+            return None
+
+        try:
+            getifaddrs = _libc.getifaddrs
+            freeifaddrs = _libc.freeifaddrs
+        except AttributeError:
+            return None
+        getifaddrs.argtypes = [ctypes.POINTER(ctypes.POINTER(_IfAddrs))]
+        getifaddrs.restype = ctypes.c_int
+        freeifaddrs.argtypes = [ctypes.POINTER(_IfAddrs)]
+        freeifaddrs.restype = None
+
+        head = ctypes.POINTER(_IfAddrs)()
+        if getifaddrs(ctypes.byref(head)) != 0:
+            return None
+
+        interfaces = []
+        try:
+            node = head
+            while node:
+                entry = node.contents
+                node = entry.ifa_next
+                if not entry.ifa_addr or entry.ifa_addr.contents.sa_family != socket.AF_INET:
+                    continue
+                name = entry.ifa_name.decode(errors='replace')
+                if not self._interface_allowed(name, entry.ifa_flags & IFF_UP):
+                    continue
+
+                addr = ctypes.cast(entry.ifa_addr, ctypes.POINTER(_SockAddrIn)).contents
+                ip_addr = socket.inet_ntoa(bytes(addr.sin_addr))
+                # Skip loopback
+                if ip_addr.startswith('127.'):
+                    continue
+
+                prefix = 24
+                if entry.ifa_netmask:
+                    mask = ctypes.cast(entry.ifa_netmask, ctypes.POINTER(_SockAddrIn)).contents
+                    prefix = bin(int.from_bytes(bytes(mask.sin_addr), "big")).count("1")
+
+                interfaces.append({
+                    'name': name,
+                    'ip': ip_addr,
+                    'cidr': f"{ip_addr}/{prefix}"
+                })
+        finally:
+            freeifaddrs(head)
+        return interfaces
+
+    def _parse_ip_addr_output(self, output):
+        """Parse the text output of `ip -4 addr show` into interface dicts"""
+        interfaces = []
+        current_interface = None
+        for line in output.splitlines():
+            match = _IP_ADDR_LINE_RE.match(line)
+            if not match:
+                continue
+
+            # Interface header line: "2: eth0@if5: <BROADCAST,UP,...> ..."
+            if match.group('name'):
+                current_interface = match.group('name')
+                is_up = 'UP' in match.group('flags').split(',')
+                if not self._interface_allowed(current_interface, is_up):
+                    current_interface = None
+
+            # Address line: "inet 192.168.1.10/24 ..."
+            elif current_interface:
+                ip_addr = match.group('ip')
+                # Skip loopback
+                if not ip_addr.startswith('127.'):
+                    interfaces.append({
+                        'name': current_interface,
+                        'ip': ip_addr,
+                        'cidr': f"{ip_addr}/{match.group('prefix')}"
+                    })
+        return interfaces
     
     def get_user_input_with_timeout(self, prompt, timeout=60):
         """Get user input with timeout"""
@@ -108,9 +736,10 @@ class SMBServerSetup:
         
         # For Unix-like systems
         if hasattr(select, 'select'):
-            ready, _, _ = select.select([sys.stdin], [], [], timeout)
+            ready = b"\n" in self._stdin_pending or select.select([sys.stdin], [], [], timeout)[0]
             if ready:
-                return sys.stdin.readline().strip()
+                line = self._read_stdin_line()
+                return line.strip() if line is not None else None
             else:
                 return None
         else:
@@ -119,6 +748,71 @@ class SMBServerSetup:
             time.sleep(timeout)
             return None
     
+    def _read_stdin_line(self):
+        """Read one line straight from the stdin fd.
+
+        Bypasses sys.stdin's buffer so bytes never hide from select().
+        Returns None if only a partial line is available yet and raises
+        EOFError once stdin is closed.
+        """
+        if b"\n" not in self._stdin_pending:
+            chunk = os.read(sys.stdin.fileno(), 4096)
+            if not chunk:
+                if not self._stdin_pending:
+                    raise EOFError
+                chunk = b"\n"  # Terminate a trailing partial line at EOF
+            self._stdin_pending += chunk
+            if b"\n" not in self._stdin_pending:
+                return None
+        line, _, self._stdin_pending = self._stdin_pending.partition(b"\n")
+        return line.decode(errors="replace")
+
+    def _countdown_input(self, prompt, timeout=60, tick=5, skip_empty=False):
+        """Wait for a line of input while showing a coarse countdown.
+
+        Blocks in select() for up to `tick` seconds at a time and only
+        re-renders the prompt when the remaining time changes. Returns the
+        stripped input, or None when the timeout expires.
+        """
+        if not hasattr(select, 'select'):
+            # Fallback for systems without select: nothing can be read anyway
+            print(prompt.format(remaining=timeout), end='', flush=True)
+            time.sleep(timeout)
+            return None
+
+        # Pre-encode the invariant parts of the prompt; only the digits change
+        before, _, after = prompt.partition("{remaining}")
+        prefix = f"\r{before}".encode()
+        suffix = after.encode()
+        stdout_fd = sys.stdout.fileno()
+        sys.stdout.flush()
+
+        deadline = time.monotonic() + timeout
+        last_shown = None
+        while True:
+            remaining = int(deadline - time.monotonic() + 0.999)
+            if remaining <= 0:
+                return None
+            if remaining != last_shown:
+                os.write(stdout_fd, prefix + str(remaining).encode() + suffix)
+                last_shown = remaining
+            ready = b"\n" in self._stdin_pending or select.select([sys.stdin], [], [], min(tick, remaining))[0]
+            if ready:
+                line = self._read_stdin_line()
+                if line is None:
+                    continue  # Partial line, wait for the rest
+                user_input = line.strip()
+                if user_input or not skip_empty:
+                    return user_input
+
+    def _read_line(self, prompt):
+        """Blocking input() replacement that shares _read_stdin_line's buffer"""
+        print(prompt, end='', flush=True)
+        line = None
+        while line is None:
+            line = self._read_stdin_line()
+        return line
+
     def select_network_binding(self):
         """Let user select network interface binding with countdown"""
         print("\n🌐 Network Interface Detection")
@@ -131,6 +825,23 @@ class SMBServerSetup:
             print("💡 Please ensure your network interfaces are properly configured.")
             sys.exit(1)
         
+        # Non-interactive selection: the requested interface, or the first one
+        if self.requested_interface or self.assume_yes:
+            selected = interfaces[0]
+            if self.requested_interface:
+                matches = [interface for interface in interfaces
+                           if self.requested_interface in (interface['name'], interface['ip'])]
+                if not matches:
+                    print(f"❌ Interface '{self.requested_interface}' not found among detected interfaces.")
+                    sys.exit(1)
+                selected = matches[0]
+            self.bind_interfaces = selected['ip']
+            self.bind_interface_name = selected['name']
+            print(f"✅ Selected: Bind to {selected['name']} ({selected['ip']})")
+            print(f"🔗 Samba will bind to: {self.bind_interface_name} ({self.bind_interfaces})")
+            print()
+            return
+        
         print("📡 Available network interfaces:")
         print()
         
@@ -154,87 +865,57 @@ class SMBServerSetup:
         print()
         
         # Countdown with user input
-        user_input = None
-        for remaining in range(60, 0, -1):
-            prompt = f"⌛ Select option [1-{len(options)}] ({remaining}s remaining): "
-            
-            try:
-                # Use select for non-blocking input with 1-second timeout
-                if hasattr(select, 'select'):
-                    print(f"\r{prompt}", end='', flush=True)
-                    ready, _, _ = select.select([sys.stdin], [], [], 1)
-                    if ready:
-                        user_input = sys.stdin.readline().strip()
-                        if user_input:
-                            break
-                else:
-                    # Fallback for systems without select
-                    if remaining == 60:
-                        print(prompt, end='', flush=True)
-                    time.sleep(1)
-                    continue
-            except (KeyboardInterrupt, EOFError):
-                print("\n\n❌ Selection interrupted, using first available interface")
-                user_input = "1"
-                break
-        else:
-            # Timeout reached
-            print("\r⏰ Timeout reached! Auto-selecting first available interface...")
+        prompt = f"⌛ Select option [1-{len(options)}] ({{remaining}}s remaining): "
+        try:
+            user_input = self._countdown_input(prompt, timeout=60, skip_empty=True)
+        except (KeyboardInterrupt, EOFError):
+            print("\n\n❌ Selection interrupted, using first available interface")
             user_input = "1"
+        else:
+            if user_input is None:
+                # Timeout reached
+                print("\r⏰ Timeout reached! Auto-selecting first available interface...")
+                user_input = "1"
         
+        # Map IPs back to interface names for the Samba config
+        ip_to_name = {interface['ip']: interface['name'] for interface in interfaces}
+
         # Process user input
+        selected_option = self._resolve_choice(user_input, options)
+        self.bind_interfaces = selected_option['value']
+        # Fallback to a common default if interface name not found
+        self.bind_interface_name = ip_to_name.get(self.bind_interfaces, "eth0")
+        
+        print(f"🔗 Samba will bind to: {self.bind_interface_name} ({self.bind_interfaces})")
+        print()
+
+    def _resolve_choice(self, user_input, options):
+        """Map 1-based user input to an option, falling back to the first one"""
         try:
             choice_index = int(user_input) - 1  # Convert to 0-based index
             if 0 <= choice_index < len(options):
                 selected_option = options[choice_index]
-                self.bind_interfaces = selected_option['value']
-                # Also store the interface name for Samba config
-                interfaces_data = self.get_network_interfaces()
-                for interface in interfaces_data:
-                    if interface['ip'] == selected_option['value']:
-                        self.bind_interface_name = interface['name']
-                        break
-                # Fallback if interface name not found
-                if not self.bind_interface_name:
-                    self.bind_interface_name = "eth0"  # Common default
                 print(f"\n✅ Selected: {selected_option['description']}")
-            else:
-                print(f"\n⚠️  Invalid choice '{user_input}', using first available interface")
-                selected_option = options[0]
-                self.bind_interfaces = selected_option['value']
-                # Also store the interface name for Samba config
-                interfaces_data = self.get_network_interfaces()
-                for interface in interfaces_data:
-                    if interface['ip'] == selected_option['value']:
-                        self.bind_interface_name = interface['name']
-                        break
-                # Fallback if interface name not found
-                if not self.bind_interface_name:
-                    self.bind_interface_name = "eth0"  # Common default
-                print(f"✅ Auto-selected: {selected_option['description']}")
-        except (ValueError, IndexError):
+                return selected_option
+            print(f"\n⚠️  Invalid choice '{user_input}', using first available interface")
+        except (ValueError, TypeError):
             print(f"\n⚠️  Invalid input '{user_input}', using first available interface")
-            selected_option = options[0]
-            self.bind_interfaces = selected_option['value']
-            # Also store the interface name for Samba config
-            interfaces_data = self.get_network_interfaces()
-            for interface in interfaces_data:
-                if interface['ip'] == selected_option['value']:
-                    self.bind_interface_name = interface['name']
-                    break
-            # Fallback if interface name not found
-            if not self.bind_interface_name:
-                self.bind_interface_name = "eth0"  # Common default
-            print(f"✅ Auto-selected: {selected_option['description']}")
-        
-        print(f"🔗 Samba will bind to: {self.bind_interface_name} ({self.bind_interfaces})")
-        print()
+
+        selected_option = options[0]
+        print(f"✅ Auto-selected: {selected_option['description']}")
+        return selected_option
 
     def select_smb_version(self):
         """Allow user to select SMB protocol version with timeout"""
         print("\n📡 SMB Protocol Version Selection")
         print("=" * 50)
         
+        # Non-interactive selection: keep the configured/default protocol range
+        if self.smb_protocols_fixed or self.assume_yes:
+            print(f"🔐 SMB Protocol Configuration: {self.smb_min_protocol} to {self.smb_max_protocol}")
+            print()
+            return
+        
         # Define SMB version options
         smb_options = [
             {
@@ -275,39 +956,17 @@ class SMBServerSetup:
         print("💡 SMBv1 is recommended for maximum compatibility with older Windows systems.")
         
         # Timeout selection logic
-        user_input = None
-        start_time = time.time()
-        timeout = 60
-        
-        while time.time() - start_time < timeout:
-            remaining = int(timeout - (time.time() - start_time))
-            prompt = f"⌛ Select option [0-{len(smb_options)-1}] ({remaining}s remaining): "
-            
-            try:
-                # Check if input is available
-                sys.stdout.write(f"\r{prompt}")
-                sys.stdout.flush()
-                
-                # Use select to check for input availability (Unix-like systems)
-                if hasattr(select, 'select'):
-                    ready, _, _ = select.select([sys.stdin], [], [], 1)
-                    if ready:
-                        user_input = sys.stdin.readline().strip()
-                        break
-                else:
-                    # Fallback for systems without select
-                    if remaining == 60:
-                        print(prompt, end='', flush=True)
-                    time.sleep(1)
-                    continue
-            except (KeyboardInterrupt, EOFError):
-                print("\n\n❌ Selection interrupted, using default SMBv1 compatibility")
-                user_input = "0"
-                break
-        else:
-            # Timeout reached
-            print("\r⏰ Timeout reached! Auto-selecting option [0] (SMBv1 compatibility)...")
+        prompt = f"⌛ Select option [0-{len(smb_options)-1}] ({{remaining}}s remaining): "
+        try:
+            user_input = self._countdown_input(prompt, timeout=60)
+        except (KeyboardInterrupt, EOFError):
+            print("\n\n❌ Selection interrupted, using default SMBv1 compatibility")
             user_input = "0"
+        else:
+            if user_input is None:
+                # Timeout reached
+                print("\r⏰ Timeout reached! Auto-selecting option [0] (SMBv1 compatibility)...")
+                user_input = "0"
         
         # Process user input
         try:
@@ -333,70 +992,102 @@ class SMBServerSetup:
         print()
 
     def detect_os(self):
-        """Detect the operating system and return package manager info"""
+        """Detect the operating system and return package manager info (cached)"""
+        if self._os_info_cache is None:
+            self._os_info_cache = self._detect_os()
+        return self._os_info_cache
+
+    @disk_cached("os_info")
+    def _detect_os(self):
+        """Probe the operating system and return package manager info"""
         print("🔍 Detecting operating system...")
 
         try:
+            # Classify by os-release ID, then ID_LIKE, in a single file read
+            release = read_os_release()
+            ids = [release.get("ID", "")] + release.get("ID_LIKE", "").split()
+            family = next((OS_RELEASE_FAMILIES[i] for i in ids if i in OS_RELEASE_FAMILIES), None)
+
+            if family is None:
+                # Fall back to the release marker files, reading /etc once
+                try:
+                    with os.scandir("/etc") as it:
+                        etc_entries = {entry.name for entry in it}
+                except OSError:
+                    etc_entries = set()
+                family = next((name for marker, name in ETC_RELEASE_FAMILIES
+                               if marker in etc_entries), None)
+
             # Check for Debian/Ubuntu systems
-            if os.path.exists("/etc/debian_version"):
+            if family == "debian":
                 print("✅ Detected Debian-based system (Ubuntu/Debian)")
                 return {
                     "type": "debian",
-                    "update_cmd": ["apt", "update"],
-                    "install_cmd": ["apt", "install", "-y", "samba"],
-                    "package_manager": "apt"
+                    "update_cmd": ["apt-get", "update"],
+                    "install_cmd": ["apt-get", "install", "-y", "-q", "--no-install-recommends"],
+                    "packages": {"samba": "smbd", "smbclient": "smbclient"},
+                    "package_manager": "apt-get",
+                    "index_path": "/var/lib/apt/lists"
                 }
 
             # Check for Red Hat/Fedora systems
-            elif os.path.exists("/etc/redhat-release") or os.path.exists("/etc/fedora-release"):
+            elif family == "redhat":
                 print("✅ Detected Red Hat-based system (Fedora/RHEL/CentOS)")
                 return {
                     "type": "redhat",
                     "update_cmd": ["dnf", "check-update"],
-                    "install_cmd": ["dnf", "install", "-y", "samba"],
-                    "package_manager": "dnf"
+                    "install_cmd": ["dnf", "install", "-y", "-q", "--setopt=install_weak_deps=False"],
+                    "packages": {"samba": "smbd", "samba-client": "smbclient"},
+                    "package_manager": "dnf",
+                    "index_path": "/var/cache/dnf"
                 }
 
             # Check for older CentOS/RHEL systems that might use yum
-            elif os.path.exists("/etc/centos-release"):
+            elif family == "centos":
                 # Check if dnf is available, fallback to yum
-                try:
-                    subprocess.run(["which", "dnf"], check=True,
-                                   capture_output=True)
+                if shutil.which("dnf"):
                     print("✅ Detected CentOS with DNF")
                     return {
                         "type": "redhat",
                         "update_cmd": ["dnf", "check-update"],
-                        "install_cmd": ["dnf", "install", "-y", "samba"],
-                        "package_manager": "dnf"
+                        "install_cmd": ["dnf", "install", "-y", "-q", "--setopt=install_weak_deps=False"],
+                        "packages": {"samba": "smbd", "samba-client": "smbclient"},
+                        "package_manager": "dnf",
+                        "index_path": "/var/cache/dnf"
                     }
-                except subprocess.CalledProcessError:
+                else:
                     print("✅ Detected CentOS with YUM")
                     return {
                         "type": "redhat",
                         "update_cmd": ["yum", "check-update"],
-                        "install_cmd": ["yum", "install", "-y", "samba"],
-                        "package_manager": "yum"
+                        "install_cmd": ["yum", "install", "-y", "-q"],
+                        "packages": {"samba": "smbd", "samba-client": "smbclient"},
+                        "package_manager": "yum",
+                        "index_path": "/var/cache/yum"
                     }
 
             # Check for Arch Linux
-            elif os.path.exists("/etc/arch-release"):
+            elif family == "arch":
                 print("✅ Detected Arch Linux")
                 return {
                     "type": "arch",
                     "update_cmd": ["pacman", "-Sy"],
-                    "install_cmd": ["pacman", "-S", "--noconfirm", "samba"],
-                    "package_manager": "pacman"
+                    "install_cmd": ["pacman", "-S", "--noconfirm", "--needed"],
+                    "packages": {"samba": "smbd", "smbclient": "smbclient"},
+                    "package_manager": "pacman",
+                    "index_path": "/var/lib/pacman/sync"
                 }
 
             # Check for openSUSE
-            elif os.path.exists("/etc/SUSE-brand") or os.path.exists("/etc/SuSE-release"):
+            elif family == "suse":
                 print("✅ Detected openSUSE")
                 return {
                     "type": "suse",
                     "update_cmd": ["zypper", "refresh"],
-                    "install_cmd": ["zypper", "install", "-y", "samba"],
-                    "package_manager": "zypper"
+                    "install_cmd": ["zypper", "--quiet", "install", "-y"],
+                    "packages": {"samba": "smbd", "samba-client": "smbclient"},
+                    "package_manager": "zypper",
+                    "index_path": "/var/cache/zypp/raw"
                 }
 
             else:
@@ -404,139 +1095,270 @@ class SMBServerSetup:
                 print("⚠️  Unknown Linux distribution, defaulting to apt")
                 return {
                     "type": "unknown",
-                    "update_cmd": ["apt", "update"],
-                    "install_cmd": ["apt", "install", "-y", "samba"],
-                    "package_manager": "apt"
+                    "update_cmd": ["apt-get", "update"],
+                    "install_cmd": ["apt-get", "install", "-y", "-q", "--no-install-recommends"],
+                    "packages": {"samba": "smbd", "smbclient": "smbclient"},
+                    "package_manager": "apt-get",
+                    "index_path": "/var/lib/apt/lists"
                 }
 
         except Exception as e:
             print(f"⚠️  Error detecting OS: {e}, defaulting to apt")
             return {
                 "type": "unknown",
-                "update_cmd": ["apt", "update"],
-                "install_cmd": ["apt", "install", "-y", "samba"],
-                "package_manager": "apt"
+                "update_cmd": ["apt-get", "update"],
+                "install_cmd": ["apt-get", "install", "-y", "-q", "--no-install-recommends"],
+                "packages": {"samba": "smbd", "smbclient": "smbclient"},
+                "package_manager": "apt-get",
+                "index_path": "/var/lib/apt/lists"
             }
 
     def install_samba(self):
         """Install Samba server if not already installed"""
         print("🔍 Checking if Samba is installed...")
 
-        # Check if samba is installed
-        try:
-            subprocess.run(["which", "smbd"], check=True, capture_output=True)
-            print("✅ Samba is already installed")
-            return
-        except subprocess.CalledProcessError:
-            pass
-
         # Detect OS and get package manager info
         os_info = self.detect_os()
 
+        # Check which packages are missing by looking for their binaries
+        missing = [package for package, binary in os_info['packages'].items()
+                   if not shutil.which(binary)]
+        if not missing:
+            print("✅ Samba is already installed")
+            return
+        install_cmd = os_info['install_cmd'] + missing
+
         print(
-            f"📦 Installing Samba server using {os_info['package_manager']}...")
+            f"📦 Installing {', '.join(missing)} using {os_info['package_manager']}...")
+        env = None
+        if os_info['package_manager'] == 'apt-get':
+            env = {**os.environ, "DEBIAN_FRONTEND": "noninteractive"}
         try:
-            # Update package list (skip for dnf check-update as it may return non-zero)
-            if os_info['type'] == 'redhat' and 'check-update' in os_info['update_cmd']:
-                print(
-                    f"🔄 Checking for updates with {os_info['package_manager']}...")
-                # dnf check-update returns exit code 100 when updates are available
-                result = subprocess.run(
-                    os_info['update_cmd'], capture_output=True)
-                if result.returncode not in [0, 100]:
-                    print(
-                        f"⚠️  Update check returned code {result.returncode}, continuing...")
+            # Update package list only when the install could not succeed without it
+            refreshed = self._needs_index_refresh(os_info)
+            if refreshed:
+                self._refresh_package_index(os_info, env)
             else:
                 print(
-                    f"🔄 Updating package list with {os_info['package_manager']}...")
-                subprocess.run(os_info['update_cmd'], check=True)
+                    f"ℹ️  {os_info['package_manager']} package index is usable, skipping refresh")
 
             # Install samba
             print(f"📥 Installing Samba with {os_info['package_manager']}...")
-            subprocess.run(os_info['install_cmd'], check=True)
+            try:
+                self._sh(install_cmd, env=env)
+            except subprocess.CalledProcessError:
+                if refreshed:
+                    raise
+                # The skipped index may point at superseded package versions
+                print("⚠️  Install failed with the existing package index, refreshing and retrying...")
+                self._refresh_package_index(os_info, env)
+                self._sh(install_cmd, env=env)
             print("✅ Samba installed successfully")
         except subprocess.CalledProcessError as e:
             print(
                 f"❌ Failed to install Samba with {os_info['package_manager']}: {e}")
-            print(f"💡 Try manually: sudo {' '.join(os_info['install_cmd'])}")
+            print(f"💡 Try manually: sudo {' '.join(install_cmd)}")
+            print("💡 Or rerun with --force-refresh to refresh the package index first")
             sys.exit(1)
 
+    def _refresh_package_index(self, os_info, env=None):
+        """Refresh the package manager's index before installing"""
+        if os_info['type'] == 'redhat' and 'check-update' in os_info['update_cmd']:
+            print(
+                f"🔄 Checking for updates with {os_info['package_manager']}...")
+            if self.dry_run:
+                self._print_dry_run(os_info['update_cmd'])
+                return
+            # dnf check-update returns exit code 100 when updates are available
+            result = subprocess.run(
+                os_info['update_cmd'], capture_output=True)
+            if result.returncode not in [0, 100]:
+                print(
+                    f"⚠️  Update check returned code {result.returncode}, continuing...")
+        else:
+            print(
+                f"🔄 Updating package list with {os_info['package_manager']}...")
+            self._sh(os_info['update_cmd'], env=env)
+
+    def _needs_index_refresh(self, os_info):
+        """Decide whether the package index must be refreshed before installing"""
+        if self.force_refresh:
+            return True
+        if os_info['type'] == 'redhat':
+            # dnf/yum refresh expired metadata on install by themselves
+            return False
+        if self._package_index_is_fresh(os_info):
+            return False
+        if os_info['package_manager'] == 'apt-get':
+            # A stale index is still fine as long as it knows about samba
+            return not self._apt_has_candidate("samba")
+        return True
+
+    def _apt_has_candidate(self, package):
+        """Check whether apt's current index has an install candidate for package"""
+        try:
+            result = subprocess.run(["apt-cache", "policy", package],
+                                    capture_output=True, text=True)
+        except FileNotFoundError:
+            return False
+        for line in result.stdout.splitlines():
+            line = line.strip()
+            if line.startswith("Candidate:"):
+                return "(none)" not in line
+        return False
+
+    def _package_index_is_fresh(self, os_info, max_age=PACKAGE_INDEX_MAX_AGE):
+        """Check whether the package index was refreshed within max_age seconds"""
+        index_path = os_info.get('index_path')
+        if not index_path:
+            return False
+        try:
+            age = time.time() - os.path.getmtime(index_path)
+        except OSError:
+            return False
+        return age < max_age
+
     def backup_samba_config(self):
         """Backup existing Samba configuration"""
         if os.path.exists(self.samba_config):
-            if not os.path.exists(self.backup_config):
-                print("💾 Backing up existing Samba configuration...")
-                try:
-                    shutil.copy2(self.samba_config, self.backup_config)
-                    print(f"✅ Backup created: {self.backup_config}")
-                except Exception as e:
-                    print(f"❌ Failed to backup config: {e}")
-                    sys.exit(1)
-            else:
+            # The first backup keeps the original config; later changes get
+            # timestamped backups, unless identical to the newest one
+            newest = self._newest_backup()
+            if newest is None:
+                backup_path = self.backup_config
+            elif _file_digest(newest) == _file_digest(self.samba_config):
                 print("✅ Backup already exists")
+                return
+            else:
+                backup_path = f"{self.backup_config}.{int(time.time())}"
+            print("💾 Backing up existing Samba configuration...")
+            if self.dry_run:
+                self._print_dry_run(["cp", "-p", self.samba_config, backup_path])
+                return
+            try:
+                # copyfile uses the sendfile fast path on Linux
+                shutil.copyfile(self.samba_config, backup_path)
+                shutil.copystat(self.samba_config, backup_path)
+                print(f"✅ Backup created: {backup_path}")
+            except Exception as e:
+                print(f"❌ Failed to backup config: {e}")
+                sys.exit(1)
 
-    def create_samba_config(self):
-        """Create Samba configuration for anonymous access"""
-        print("⚙️  Creating Samba configuration...")
+    def _newest_backup(self):
+        """Return the path of the most recent config backup, or None"""
+        directory, base = os.path.split(self.backup_config)
+        stamped = []
+        try:
+            with os.scandir(directory) as it:
+                for entry in it:
+                    suffix = entry.name[len(base) + 1:]
+                    if entry.name.startswith(base + ".") and suffix.isdigit():
+                        stamped.append((int(suffix), entry.path))
+        except OSError:
+            pass
+        if stamped:
+            return max(stamped)[1]
+        return self.backup_config if os.path.exists(self.backup_config) else None
 
+    def _render_samba_config(self, nobody_user=None, nobody_group=None):
+        """Return the smb.conf bytes for the current settings"""
         # Get appropriate nobody user and group for this system
-        nobody_user, nobody_group = self.get_nobody_user_group()
+        if nobody_user is None or nobody_group is None:
+            nobody_user, nobody_group = self.get_nobody_user_group()
 
-        config_content = f"""# Samba configuration for anonymous access
-# Global settings
-[global]
-    workgroup = WORKGROUP
-    server string = SMB Server for File Sharing
-    netbios name = SMBSERVER
-    security = user
-    map to guest = bad user
-    guest account = {nobody_user}
-    
-    # Network binding
-    interfaces = {self.bind_interface_name}
-    bind interfaces only = yes
-    
-    # Disable printing
-    load printers = no
-    printing = bsd
-    printcap name = /dev/null
-    disable spoolss = yes
-    
-    # Performance and compatibility
-    socket options = TCP_NODELAY IPTOS_LOWDELAY SO_RCVBUF=65536 SO_SNDBUF=65536
-    min protocol = {self.smb_min_protocol}
-    max protocol = {self.smb_max_protocol}
-    
-    # Logging
-    log file = /var/log/samba/log.%m
-    max log size = 1000
-    log level = 1
+        return _SMB_CONF_TEMPLATE.substitute(
+            nobody_user=nobody_user,
+            interface=self.bind_interface_name,
+            min_protocol=self.smb_min_protocol,
+            max_protocol=self.smb_max_protocol,
+            socket_buffer=self.socket_buffer_size,
+            aio_read_size=1 if self.multichannel else 16384,
+            multichannel_options="\n    server multi channel support = yes" if self.multichannel else "",
+            share_name=self.share_name,
+            share_path=self.share_path,
+        ).encode()
+
+    def _desired_state(self, config_hash):
+        """Return the setup inputs recorded in STATE_FILE"""
+        return {
+            "share_path": self.share_path,
+            "share_name": self.share_name,
+            "bind_interfaces": self.bind_interfaces,
+            "bind_interface_name": self.bind_interface_name,
+            "smb_version": [self.smb_min_protocol, self.smb_max_protocol],
+            "config_hash": config_hash,
+            "validated_hash": config_hash,
+            "pkg_installed": True,
+        }
+
+    def _load_state(self):
+        """Load the state recorded by the last completed setup ({} if none)"""
+        try:
+            with open(STATE_FILE, 'r') as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        return state if isinstance(state, dict) else {}
+
+    def _save_state(self):
+        """Record this setup's inputs; failures are ignored"""
+        if self.dry_run:
+            return
+        try:
+            os.makedirs(os.path.dirname(STATE_FILE), mode=0o700, exist_ok=True)
+            tmp_path = f"{STATE_FILE}.tmp"
+            state = self._desired_state(self.config_hash)
+            # Only a config that passed testparm may skip it next time
+            state["validated_hash"] = self._validated_hash
+            with open(tmp_path, 'w') as f:
+                json.dump(state, f)
+            os.replace(tmp_path, STATE_FILE)
+        except OSError:
+            pass
 
-# Anonymous share for shared directory
-[{self.share_name}]
-    comment = Shared Directory (Anonymous Access)
-    path = {self.share_path}
-    browseable = yes
-    writable = yes
-    guest ok = yes
-    guest only = yes
-    create mask = 0777
-    directory mask = 0777
-    force create mode = 0777
-    force directory mode = 0777
-    public = yes
-"""
+    def _already_configured(self):
+        """Check whether the last completed setup matches the requested one and is intact"""
+        if self.force or not shutil.which("smbd"):
+            return False
+        config_hash = hashlib.blake2b(self._render_samba_config(), digest_size=16).hexdigest()
+        if (self._load_state() != self._desired_state(config_hash) or
+                _file_digest(self.samba_config) != config_hash):
+            return False
+        smb_service, _ = self.get_samba_service_names()
+        return self._service_states([smb_service]).get(smb_service) == "active"
+
+    def create_samba_config(self, nobody_user=None, nobody_group=None):
+        """Create Samba configuration for anonymous access"""
+        print("⚙️  Creating Samba configuration...")
+
+        config_bytes = self._render_samba_config(nobody_user, nobody_group)
+        self.config_hash = hashlib.blake2b(config_bytes, digest_size=16).hexdigest()
+        self._config_unchanged = _file_digest(self.samba_config) == self.config_hash
+        if self._config_unchanged:
+            # Identical to what a previous run wrote
+            print(f"✅ Samba configuration already up to date: {self.samba_config}")
+            return
+        if self.dry_run:
+            print(f"ℹ️  Dry run: would write {len(config_bytes)} bytes to {self.samba_config}")
+            return
 
         try:
-            with open(self.samba_config, 'w') as f:
-                f.write(config_content)
+            with open(self.samba_config, 'wb') as f:
+                f.write(config_bytes)
             print(f"✅ Samba configuration created: {self.samba_config}")
         except Exception as e:
             print(f"❌ Failed to create config: {e}")
             sys.exit(1)
 
     def get_nobody_user_group(self):
-        """Get the appropriate nobody user and group for the current system"""
+        """Get the appropriate nobody user and group for the current system (cached)"""
+        if self._nobody_cache is None:
+            self._nobody_cache = tuple(self._detect_nobody_user_group())
+        return self._nobody_cache
+
+    @disk_cached("nobody_user_group")
+    def _detect_nobody_user_group(self):
+        """Probe for the appropriate nobody user and group"""
         print("🔍 Detecting nobody user and group...")
 
         # Common combinations to try
@@ -549,14 +1371,12 @@ class SMBServerSetup:
 
         for user, group in combinations:
             try:
-                # Check if user exists
-                subprocess.run(["id", user], check=True, capture_output=True)
-                # Check if group exists
-                subprocess.run(["getent", "group", group],
-                               check=True, capture_output=True)
+                # Check if user and group exist
+                pwd.getpwnam(user)
+                grp.getgrnam(group)
                 print(f"✅ Found nobody user/group: {user}:{group}")
                 return user, group
-            except subprocess.CalledProcessError:
+            except KeyError:
                 continue
 
         # If none found, create a fallback approach
@@ -566,9 +1386,7 @@ class SMBServerSetup:
             current_user = os.getenv(
                 'SUDO_USER') or os.getenv('USER') or 'root'
             # Try to get primary group
-            result = subprocess.run(["id", "-gn", current_user],
-                                    capture_output=True, text=True, check=True)
-            current_group = result.stdout.strip()
+            current_group = grp.getgrgid(pwd.getpwnam(current_user).pw_gid).gr_name
             print(f"📝 Using fallback: {current_user}:{current_group}")
             return current_user, current_group
         except Exception:
@@ -576,29 +1394,29 @@ class SMBServerSetup:
             print("📝 Using ultimate fallback: root:root")
             return "root", "root"
 
-    def set_directory_permissions(self):
+    def set_directory_permissions(self, nobody_user=None, nobody_group=None):
         """Set proper permissions for the shared directory"""
         print("🔐 Setting directory permissions...")
         try:
-            # Make directory and all contents accessible
-            os.chmod(self.share_path, 0o755)
-            
-            # Set permissions recursively on all files and directories
-            for root, dirs, files in os.walk(self.share_path):
-                # Set directory permissions
-                for d in dirs:
-                    os.chmod(os.path.join(root, d), 0o755)
-                # Set file permissions
-                for f in files:
-                    os.chmod(os.path.join(root, f), 0o755)
-
             # Get appropriate nobody user and group for this system
-            nobody_user, nobody_group = self.get_nobody_user_group()
-
-            # Change ownership for anonymous access
-            chown_command = ["chown", "-R",
-                             f"{nobody_user}:{nobody_group}", self.share_path]
-            subprocess.run(chown_command, check=True)
+            if nobody_user is None or nobody_group is None:
+                nobody_user, nobody_group = self.get_nobody_user_group()
+            if self.dry_run:
+                self._print_dry_run(["chmod", "-R", "755", self.share_path])
+                self._print_dry_run(["chown", "-R", f"{nobody_user}:{nobody_group}", self.share_path])
+                return
+            uid = pwd.getpwnam(nobody_user).pw_uid
+            gid = grp.getgrnam(nobody_group).gr_gid
+
+            # Make directory and all contents accessible, and change ownership
+            # for anonymous access, in a single walk (like chmod -R/chown -R,
+            # symlinks are never followed: guests can create them in the share)
+            share_root = os.path.realpath(self.share_path)
+            os.chmod(share_root, 0o755)
+            os.chown(share_root, uid, gid)
+            for _, dirs, files, dir_fd in os.fwalk(share_root):
+                for name in dirs + files:
+                    self._chmod_chown_entry(name, dir_fd, uid, gid)
             print(
                 f"✅ Permissions set for {self.share_path} (owner: {nobody_user}:{nobody_group})")
         except Exception as e:
@@ -617,8 +1435,40 @@ class SMBServerSetup:
                 print(f"💡 Try: sudo chmod 755 {self.share_path}")
                 # Don't exit here, continue with setup
 
+    @staticmethod
+    def _chmod_chown_entry(name, dir_fd, uid, gid):
+        """Set 0755 and uid:gid on a share entry through its own fd, never through a symlink"""
+        try:
+            # Opening with O_NOFOLLOW and changing the fd leaves no window for
+            # the entry to be swapped for a symlink between check and change
+            fd = os.open(name, os.O_RDONLY | os.O_NOFOLLOW | os.O_NONBLOCK, dir_fd=dir_fd)
+        except OSError as e:
+            if e.errno == errno.ELOOP:
+                # A symlink: re-own the link itself, like chown -R
+                os.chown(name, uid, gid, dir_fd=dir_fd, follow_symlinks=False)
+            elif e.errno not in (errno.ENOENT, errno.ENXIO):
+                raise
+            return  # Removed meanwhile, or a socket that cannot be opened
+        try:
+            os.fchmod(fd, 0o755)
+            os.fchown(fd, uid, gid)
+        finally:
+            os.close(fd)
+
     def get_samba_service_names(self):
-        """Get the correct Samba service names for the current distribution"""
+        """Get the correct Samba service names for the current distribution (cached)"""
+        if self._service_names_cache is None:
+            service_names = self._detect_samba_service_names()
+            if not service_names:
+                # Default fallback (not cached on disk, Samba may not be installed yet)
+                print("⚠️  Using default service names: smbd, nmbd")
+                service_names = ("smbd", "nmbd")
+            self._service_names_cache = tuple(service_names)
+        return self._service_names_cache
+
+    @disk_cached("samba_service_names")
+    def _detect_samba_service_names(self):
+        """Probe systemd for the Samba service names"""
         print("🔍 Detecting Samba service names...")
 
         # Common service name combinations to try
@@ -630,43 +1480,24 @@ class SMBServerSetup:
             {"smb": "samba", "nmb": "winbind"},     # Alternative
         ]
 
+        # List all installed service units once and match candidates in Python
+        try:
+            result = subprocess.run(["systemctl", "list-unit-files", "--type=service", "--no-legend"],
+                                    capture_output=True, text=True)
+            units = {line.split()[0] for line in result.stdout.splitlines() if line.strip()}
+        except (subprocess.CalledProcessError, FileNotFoundError):
+            units = set()
+
         for services in service_combinations:
             smb_service = services["smb"]
             nmb_service = services["nmb"]
 
-            try:
-                # Check if the smb service exists
-                result = subprocess.run(["systemctl", "list-unit-files", f"{smb_service}.service"],
-                                        capture_output=True, text=True)
-                if f"{smb_service}.service" in result.stdout:
-                    print(
-                        f"✅ Found Samba services: {smb_service}, {nmb_service}")
-                    return smb_service, nmb_service
-            except subprocess.CalledProcessError:
-                continue
-
-        # If no services found with systemctl, try alternative detection
-        print("🔍 Trying alternative service detection...")
-
-        # Check what's actually installed
-        try:
-            result = subprocess.run(["systemctl", "list-unit-files", "*smb*", "*samba*"],
-                                    capture_output=True, text=True)
-            if "smb.service" in result.stdout:
-                print("✅ Found services: smb, nmb")
-                return "smb", "nmb"
-            elif "smbd.service" in result.stdout:
-                print("✅ Found services: smbd, nmbd")
-                return "smbd", "nmbd"
-            elif "samba.service" in result.stdout:
-                print("✅ Found service: samba")
-                return "samba", None  # Some systems only have samba service
-        except subprocess.CalledProcessError:
-            pass
+            if f"{smb_service}.service" in units:
+                print(
+                    f"✅ Found Samba services: {smb_service}, {nmb_service}")
+                return smb_service, nmb_service
 
-        # Default fallback
-        print("⚠️  Using default service names: smbd, nmbd")
-        return "smbd", "nmbd"
+        return None
 
     def start_samba_services(self):
         """Start and enable Samba services"""
@@ -678,29 +1509,27 @@ class SMBServerSetup:
         services_started = []
         services_failed = []
 
-        # Try to start SMB service
-        try:
-            print(f"🔧 Enabling {smb_service} service...")
-            subprocess.run(["systemctl", "enable", smb_service], check=True)
-            print(f"🚀 Starting {smb_service} service...")
-            subprocess.run(["systemctl", "start", smb_service], check=True)
-            services_started.append(smb_service)
-        except subprocess.CalledProcessError as e:
-            print(f"⚠️  Failed to start {smb_service}: {e}")
-            services_failed.append(smb_service)
+        units = [smb_service] + ([nmb_service] if nmb_service else [])
+        start_hints = {unit: f"sudo systemctl start {unit}" for unit in units}
 
-        # Try to start NMB service (if it exists)
-        if nmb_service:
-            try:
-                print(f"🔧 Enabling {nmb_service} service...")
-                subprocess.run(
-                    ["systemctl", "enable", nmb_service], check=True)
-                print(f"🚀 Starting {nmb_service} service...")
-                subprocess.run(["systemctl", "start", nmb_service], check=True)
-                services_started.append(nmb_service)
-            except subprocess.CalledProcessError as e:
-                print(f"⚠️  Failed to start {nmb_service}: {e}")
-                services_failed.append(nmb_service)
+        # Enable and start all units in a single systemctl call
+        print(f"🔧 Enabling and starting {', '.join(units)}...")
+        result = self._sh(["systemctl", "enable", "--now"] + units,
+                          check=False, capture_output=True, text=True)
+        if result.returncode == 0:
+            services_started.extend(units)
+        else:
+            if result.stderr.strip():
+                print(f"⚠️  {result.stderr.strip()}")
+            # Fall back to per-service calls to find out which unit failed
+            for service in units:
+                try:
+                    print(f"🚀 Enabling and starting {service} service...")
+                    self._sh(["systemctl", "enable", "--now", service])
+                    services_started.append(service)
+                except subprocess.CalledProcessError as e:
+                    print(f"⚠️  Failed to start {service}: {e}")
+                    services_failed.append(service)
 
         # Report results
         if services_started:
@@ -712,46 +1541,64 @@ class SMBServerSetup:
                 f"⚠️  Failed to start services: {', '.join(services_failed)}")
             print("🔧 Attempting manual service management...")
 
-            # Try alternative approaches
-            for service in services_failed:
-                try:
-                    print(f"🔄 Trying to restart {service}...")
-                    subprocess.run(
-                        ["systemctl", "restart", service], check=True)
-                    print(f"✅ Successfully restarted {service}")
-                    services_started.append(service)
-                except subprocess.CalledProcessError:
-                    print(
-                        f"💡 Manual command needed: sudo systemctl start {service}")
-
-        # Check if at least the main SMB service is running
-        try:
-            result = subprocess.run(["systemctl", "is-active", smb_service],
-                                    capture_output=True, text=True)
-            if "active" in result.stdout:
-                print(f"✅ {smb_service} service is running")
+            # Try alternative approaches: restart all failed units at once
+            print(f"🔄 Trying to restart {', '.join(services_failed)}...")
+            self._sh(["systemctl", "restart"] + services_failed,
+                     check=False, capture_output=True, text=True)
+
+        # Check unit states with a single is-active call
+        run_query.cache_clear()
+        states = self._service_states(units)
+        for service in services_failed:
+            if states.get(service) == "active":
+                print(f"✅ Successfully restarted {service}")
+                services_started.append(service)
             else:
                 print(
-                    f"⚠️  {smb_service} service status: {result.stdout.strip()}")
-        except subprocess.CalledProcessError:
+                    f"💡 Manual command needed: {start_hints[service]}")
+
+        # Check if at least the main SMB service is running
+        if states.get(smb_service) == "active":
+            print(f"✅ {smb_service} service is running")
+        elif smb_service in states:
+            print(
+                f"⚠️  {smb_service} service status: {states[smb_service]}")
+        else:
             print(f"⚠️  Could not check {smb_service} service status")
 
         # Don't exit on service failures, as SMB might still work
         if not services_started:
             print("⚠️  No services were started successfully")
             print("💡 You may need to start services manually after setup:")
-            print(f"💡   sudo systemctl start {smb_service}")
-            if nmb_service:
-                print(f"💡   sudo systemctl start {nmb_service}")
+            print(f"💡   sudo systemctl enable --now {' '.join(units)}")
         else:
             print("🎉 Samba service setup completed")
 
+    def _service_states(self, units):
+        """Return {unit: state} from one `systemctl is-active` call ({} if unavailable)"""
+        try:
+            result = run_query("systemctl", "is-active", *units)
+        except FileNotFoundError:
+            return {}
+        # systemctl prints one state per unit, in the order given
+        return dict(zip(units, result.stdout.split()))
+
     def test_configuration(self):
         """Test Samba configuration"""
         print("🧪 Testing Samba configuration...")
+        if (self._config_unchanged and
+                self._load_state().get("validated_hash") == self.config_hash):
+            print("✅ Samba configuration unchanged since it was last validated, skipping testparm")
+            self._validated_hash = self.config_hash
+            return
+        if self.dry_run:
+            # The generated config was not written, so there is nothing to test yet
+            self._print_dry_run(["testparm", "-s"])
+            return
         try:
             subprocess.run(["testparm", "-s"],
                            capture_output=True, text=True, check=True)
+            self._validated_hash = self.config_hash
             print("✅ Samba configuration is valid")
         except subprocess.CalledProcessError as e:
             print(f"❌ Configuration test failed: {e}")
@@ -764,27 +1611,33 @@ class SMBServerSetup:
         # Detect OS to determine firewall approach
         os_info = self.detect_os()
         
+        # Probe all firewalls concurrently; results are used in priority order
+        # (firewalld > ufw > iptables). Debian doesn't use firewalld by default.
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=3)
+        firewalld_probe = (executor.submit(self._firewalld_is_active)
+                           if os_info["type"] != "debian" else None)
+        ufw_probe = executor.submit(shutil.which, "ufw")
+        iptables_probe = executor.submit(shutil.which, "iptables")
+        executor.shutdown(wait=False)
+        
         # Skip firewalld check on Debian-based systems as they don't use firewalld by default
-        if os_info["type"] == "debian":
+        if firewalld_probe is None:
             print("ℹ️  Debian-based system detected, skipping firewalld check")
         else:
             # Check if firewalld is available and running (for Red Hat-based systems)
             try:
-                result = subprocess.run(["systemctl", "is-active", "firewalld"], 
-                                      capture_output=True, text=True)
-                if "active" in result.stdout:
+                if firewalld_probe.result():
                     print("🔍 Detected firewalld, configuring...")
                     # Check if firewall-cmd is available by trying a harmless command
                     try:
-                        subprocess.run(["firewall-cmd", "--version"], check=True, capture_output=True)
+                        run_query("firewall-cmd", "--version").check_returncode()
                     except (subprocess.CalledProcessError, FileNotFoundError):
                         print("⚠️  firewalld detected but firewall-cmd not available, skipping firewalld configuration")
                         pass  # Skip to next firewall
                     else:
                         try:
-                            # Add Samba service to default zone permanently
-                            subprocess.run(["firewall-cmd", "--add-service=samba", "--permanent"], check=True)
-                            subprocess.run(["firewall-cmd", "--add-service=samba"], check=True)
+                            # Accumulate runtime rules per zone; --runtime-to-permanent persists them
+                            zone_args = {None: ["--add-service=samba"]}
                             
                             # Check if network interface is in libvirt zone and configure accordingly
                             network_interfaces = self.get_network_interfaces()
@@ -792,27 +1645,38 @@ class SMBServerSetup:
                                 if interface['name'].startswith(('virbr', 'libvirt')):
                                     try:
                                         # Check zone of virtual interface
-                                        zone_result = subprocess.run(["firewall-cmd", f"--get-zone-of-interface={interface['name']}"], 
-                                                                    capture_output=True, text=True, check=True)
+                                        zone_result = run_query("firewall-cmd", f"--get-zone-of-interface={interface['name']}")
+                                        zone_result.check_returncode()
                                         zone = zone_result.stdout.strip()
                                         
                                         if zone == "libvirt":
                                             print(f"🔍 Found {interface['name']} in libvirt zone, adding Samba...")
-                                            # Add Samba to libvirt zone
-                                            subprocess.run(["firewall-cmd", "--zone=libvirt", "--add-service=samba", "--permanent"], check=True)
-                                            subprocess.run(["firewall-cmd", "--zone=libvirt", "--add-service=samba"], check=True)
-                                            # Add explicit ports as backup
-                                            subprocess.run(["firewall-cmd", "--zone=libvirt", "--add-port=445/tcp", "--permanent"], check=True)
-                                            subprocess.run(["firewall-cmd", "--zone=libvirt", "--add-port=139/tcp", "--permanent"], check=True)
-                                            subprocess.run(["firewall-cmd", "--zone=libvirt", "--add-port=445/tcp"], check=True)
-                                            subprocess.run(["firewall-cmd", "--zone=libvirt", "--add-port=139/tcp"], check=True)
-                                            print(f"✅ Added Samba to libvirt zone for {interface['name']}")
+                                            # Add Samba to libvirt zone, with explicit ports as backup
+                                            zone_args["libvirt"] = list(SAMBA_FIREWALLD_ARGS)
                                     except subprocess.CalledProcessError:
                                         # Interface might not be assigned to a zone yet
                                         pass
                             
-                            # Reload firewall
-                            subprocess.run(["firewall-cmd", "--reload"], check=True)
+                            # --runtime-to-permanent would overwrite permanent-only
+                            # edits that haven't been loaded yet
+                            in_sync = self._firewalld_config_in_sync()
+                            if not in_sync:
+                                print("⚠️  firewalld permanent config differs from runtime, "
+                                      "adding rules to both instead of --runtime-to-permanent")
+                            
+                            # One firewall-cmd call per zone with all --add-* flags
+                            for zone, args in zone_args.items():
+                                zone_flag = [f"--zone={zone}"] if zone else []
+                                self._sh(["firewall-cmd"] + zone_flag + args)
+                                if not in_sync:
+                                    self._sh(["firewall-cmd", "--permanent"] + zone_flag + args)
+                                if zone == "libvirt":
+                                    print("✅ Added Samba to libvirt zone")
+                            
+                            # Persist the runtime rules without a full firewall reload
+                            if in_sync:
+                                self._sh(["firewall-cmd", "--runtime-to-permanent"])
+                            run_query.cache_clear()
                             print("✅ Firewall configured for Samba (including virtual networks)")
                             return True
                         except subprocess.CalledProcessError as e:
@@ -821,40 +1685,45 @@ class SMBServerSetup:
                 pass
         
         # Check if ufw is available
-        try:
-            subprocess.run(["which", "ufw"], check=True, capture_output=True)
+        if ufw_probe.result():
             print("🔍 Detected UFW, configuring...")
             try:
-                subprocess.run(["ufw", "allow", "samba"], check=True)
+                self._sh(["ufw", "allow", "samba"])
                 print("✅ UFW configured for Samba")
                 return True
             except subprocess.CalledProcessError as e:
                 print(f"⚠️  Failed to configure UFW: {e}")
-        except subprocess.CalledProcessError:
-            pass
         
         # Check if iptables is available
-        try:
-            subprocess.run(["which", "iptables"], check=True, capture_output=True)
+        if iptables_probe.result():
             print("🔍 Detected iptables, adding rules...")
             try:
-                # Add rules for SMB ports
-                subprocess.run(["iptables", "-A", "INPUT", "-p", "tcp", "--dport", "445", "-j", "ACCEPT"], check=True)
-                subprocess.run(["iptables", "-A", "INPUT", "-p", "tcp", "--dport", "139", "-j", "ACCEPT"], check=True)
-                subprocess.run(["iptables", "-A", "INPUT", "-p", "udp", "--dport", "137", "-j", "ACCEPT"], check=True)
-                subprocess.run(["iptables", "-A", "INPUT", "-p", "udp", "--dport", "138", "-j", "ACCEPT"], check=True)
+                # Add rules for SMB ports, one multiport rule per protocol
+                self._sh(["iptables", "-A", "INPUT", "-p", "tcp", "-m", "multiport",
+                          "--dports", "139,445", "-j", "ACCEPT"])
+                self._sh(["iptables", "-A", "INPUT", "-p", "udp", "-m", "multiport",
+                          "--dports", "137,138", "-j", "ACCEPT"])
                 print("✅ iptables configured for Samba")
                 print("⚠️  Note: iptables rules are not persistent. Consider saving them.")
                 return True
             except subprocess.CalledProcessError as e:
                 print(f"⚠️  Failed to configure iptables: {e}")
-        except subprocess.CalledProcessError:
-            pass
         
         print("ℹ️  No supported firewall detected or firewall configuration failed")
         print("💡 If you have a firewall, manually allow ports 445, 139, 137, 138")
         return False
     
+    def _firewalld_is_active(self, refresh=False):
+        """Check whether the firewalld service is running (cached for the run)"""
+        if self._firewalld_active_cache is None or refresh:
+            try:
+                result = subprocess.run(["systemctl", "is-active", "firewalld"],
+                                        capture_output=True, text=True)
+                self._firewalld_active_cache = result.stdout.strip() == "active"
+            except FileNotFoundError:
+                self._firewalld_active_cache = False
+        return self._firewalld_active_cache
+
     def check_firewall_status(self):
         """Check and display firewall status for SMB services based on OS"""
         print("\n🔥 Checking firewall configuration for SMB...")
@@ -884,9 +1753,7 @@ class SMBServerSetup:
         """Check firewalld status (Red Hat/CentOS/Fedora/openSUSE)"""
         try:
             # Check if firewalld is installed and running
-            result = subprocess.run(["systemctl", "is-active", "firewalld"],
-                                  capture_output=True, text=True)
-            if "active" not in result.stdout:
+            if not self._firewalld_is_active():
                 print("ℹ️  Firewalld not active")
                 return False
 
@@ -894,8 +1761,7 @@ class SMBServerSetup:
 
             # Check if firewall-cmd is available
             try:
-                subprocess.run(["firewall-cmd", "--version"],
-                             capture_output=True, check=True)
+                run_query("firewall-cmd", "--version").check_returncode()
             except (subprocess.CalledProcessError, FileNotFoundError):
                 print("  ❌ firewall-cmd not found")
                 return False
@@ -921,7 +1787,9 @@ class SMBServerSetup:
                     print("  ✅ Samba service enabled in libvirt zone")
                 else:
                     print("  ❌ Samba service NOT enabled in libvirt zone")
-                    print("  💡 Run: sudo firewall-cmd --zone=libvirt --add-service=samba --permanent")
+                    print("  💡 Run: sudo firewall-cmd --zone=libvirt --add-service=samba"
+                          " && sudo firewall-cmd --runtime-to-permanent")
+                    print("     (--runtime-to-permanent overwrites unapplied --permanent edits)")
             except subprocess.CalledProcessError:
                 print("  ℹ️  Libvirt zone not found or not configured")
 
@@ -948,10 +1816,12 @@ class SMBServerSetup:
 
     def _check_ufw_firewall(self):
         """Check UFW status (Ubuntu/Debian)"""
-        try:
-            # Check if UFW is installed
-            subprocess.run(["which", "ufw"], capture_output=True, check=True)
+        # Check if UFW is installed
+        if not shutil.which("ufw"):
+            print("ℹ️  UFW not installed")
+            return False
 
+        try:
             # Check UFW status
             result = subprocess.run(["ufw", "status"], capture_output=True, text=True, check=True)
 
@@ -979,34 +1849,49 @@ class SMBServerSetup:
             print("ℹ️  UFW not installed")
             return False
 
+    def _firewalld_config_in_sync(self):
+        """Check whether firewalld's permanent config matches its runtime config"""
+        listings = []
+        for argv in (("firewall-cmd", "--list-all-zones"),
+                     ("firewall-cmd", "--permanent", "--list-all-zones")):
+            try:
+                result = run_query(*argv)
+                result.check_returncode()
+            except (subprocess.CalledProcessError, FileNotFoundError):
+                return False
+            # Zone headers carry runtime-only "(active)" markers
+            listings.append([_FIREWALLD_ZONE_MARKER_RE.sub(r"\1", line).rstrip()
+                             for line in result.stdout.splitlines()])
+        return listings[0] == listings[1]
+
     def _check_iptables_firewall(self):
         """Check iptables status (fallback for systems without modern firewalls)"""
-        try:
-            # Check if iptables is available
-            subprocess.run(["which", "iptables"], capture_output=True, check=True)
+        # Check if iptables is available
+        if not shutil.which("iptables"):
+            print("ℹ️  iptables not installed")
+            return False
 
+        try:
             print("🔍 iptables Status:")
 
-            # Check for SMB rules
-            smb_ports = ["445", "139", "137", "138"]
-            found_rules = []
-
-            for port in smb_ports:
-                try:
-                    # Check TCP ports
-                    if port in ["445", "139"]:
-                        result = subprocess.run(["iptables", "-L", "INPUT", "-n"],
-                                              capture_output=True, text=True, check=True)
-                        if f"dpt:{port}" in result.stdout:
-                            found_rules.append(f"{port}/tcp")
-                    # Check UDP ports
-                    else:
-                        result = subprocess.run(["iptables", "-L", "INPUT", "-n"],
-                                              capture_output=True, text=True, check=True)
-                        if f"dpt:{port}" in result.stdout:
-                            found_rules.append(f"{port}/udp")
-                except subprocess.CalledProcessError:
-                    continue
+            # Check for SMB rules, reading the INPUT chain once
+            smb_ports = [(445, "tcp"), (139, "tcp"), (137, "udp"), (138, "udp")]
+            result = subprocess.run(["iptables", "-L", "INPUT", "-n"],
+                                  capture_output=True, text=True, check=True)
+            open_ports = set()
+            for line in result.stdout.splitlines():
+                fields = line.split()
+                for match in _IPTABLES_DPORTS_RE.finditer(line):
+                    # Each comma-separated item is a port or a first:last range
+                    for item in match.group(1).split(","):
+                        first, _, last = item.partition(":")
+                        if not first.isdigit():
+                            continue
+                        last = last if last.isdigit() else first
+                        open_ports.update((port, fields[1]) for port, _ in smb_ports
+                                          if int(first) <= port <= int(last))
+            found_rules = [f"{port}/{proto}" for port, proto in smb_ports
+                           if (port, proto) in open_ports]
 
             if found_rules:
                 print(f"  ✅ Found iptables rules for: {', '.join(found_rules)}")
@@ -1040,14 +1925,23 @@ class SMBServerSetup:
             print("ℹ️  SuSEfirewall2 not available")
             return False
     
+    def _selinux_status(self):
+        """Return the getenforce status string (Enforcing/Permissive/Disabled)"""
+        if selinux is not None:
+            if not selinux.is_selinux_enabled():
+                return "Disabled"
+            return "Enforcing" if selinux.security_getenforce() == 1 else "Permissive"
+        result = run_query("getenforce")
+        result.check_returncode()
+        return result.stdout.strip()
+
     def configure_selinux(self):
         """Configure SELinux for Samba if available"""
         print("🛡️  Configuring SELinux for Samba...")
         
         try:
             # Check if SELinux is available
-            result = subprocess.run(["getenforce"], capture_output=True, text=True, check=True)
-            selinux_status = result.stdout.strip()
+            selinux_status = self._selinux_status()
             
             if selinux_status == "Disabled":
                 print("ℹ️  SELinux is disabled, skipping configuration")
@@ -1056,15 +1950,16 @@ class SMBServerSetup:
                 print(f"🔍 SELinux is {selinux_status}, configuring...")
                 
                 try:
-                    # Set SELinux context for the shared directory
-                    subprocess.run(["semanage", "fcontext", "-a", "-t", "samba_share_t", 
-                                  f"{self.share_path}(/.*)?"], check=True)
-                    subprocess.run(["restorecon", "-R", self.share_path], check=True)
+                    # Set SELinux context for the shared directory, and enable Samba
+                    # home directory access if needed, in one semanage transaction
+                    home_share = "/home/" in self.share_path
+                    commands = [f"fcontext -a -t samba_share_t {shlex.quote(self.share_path + '(/.*)?')}"]
+                    if home_share:
+                        commands.append("boolean -m --on samba_enable_home_dirs")
+                    self._sh(["semanage", "import"], input="\n".join(commands) + "\n", text=True)
+                    self._sh(["restorecon", "-R", self.share_path])
                     print(f"✅ SELinux context set for {self.share_path}")
-                    
-                    # Enable Samba home directory access if needed
-                    if "/home/" in self.share_path:
-                        subprocess.run(["setsebool", "-P", "samba_enable_home_dirs", "on"], check=True)
+                    if home_share:
                         print("✅ SELinux configured for home directory access")
                     
                     return True
@@ -1088,22 +1983,24 @@ class SMBServerSetup:
         print("🔍 Verifying SMB connectivity...")
         
         # Install smbclient if not available
-        try:
-            subprocess.run(["which", "smbclient"], check=True, capture_output=True)
-        except subprocess.CalledProcessError:
-            print("📦 Installing samba-client for testing...")
+        # (normally it was installed together with Samba)
+        if not shutil.which("smbclient"):
             os_info = self.detect_os()
+            client_packages = [package for package, binary in os_info['packages'].items()
+                               if binary == "smbclient"]
+            print(f"📦 Installing {', '.join(client_packages)} for testing...")
             try:
-                if os_info['type'] == 'redhat':
-                    subprocess.run(["dnf", "install", "-y", "samba-client"], check=True)
-                else:
-                    subprocess.run(["apt", "install", "-y", "smbclient"], check=True)
-            except subprocess.CalledProcessError:
+                self._sh(os_info['install_cmd'] + client_packages)
+            except (subprocess.CalledProcessError, FileNotFoundError):
                 print("⚠️  Could not install smbclient for testing")
                 return False
         
         # Test connection
         test_ip = self.bind_interfaces
+        if self.dry_run:
+            # Nothing was applied, so there is no server to reach yet
+            self._print_dry_run(["smbclient", "-L", test_ip, "-N"])
+            return None
         
         try:
             print(f"🧪 Testing connection to {test_ip}...")
@@ -1129,22 +2026,26 @@ class SMBServerSetup:
         
         issues_found = []
         fixes_applied = []
+        skipped_checks = []
         
         # Check if services are running
         smb_service, nmb_service = self.get_samba_service_names()
+        units = [smb_service] + ([nmb_service] if nmb_service else [])
         
-        try:
-            result = subprocess.run(["systemctl", "is-active", smb_service], 
-                                  capture_output=True, text=True)
-            if "active" not in result.stdout:
-                issues_found.append(f"{smb_service} service not running")
+        states = self._service_states(units)
+        if not states:
+            issues_found.append(f"Cannot check {smb_service} status")
+        else:
+            stopped = [unit for unit in units if states.get(unit) != "active"]
+            if stopped:
+                for unit in stopped:
+                    issues_found.append(f"{unit} service not running")
                 try:
-                    subprocess.run(["systemctl", "restart", smb_service], check=True)
-                    fixes_applied.append(f"Restarted {smb_service} service")
+                    self._sh(["systemctl", "restart"] + stopped)
+                    fixes_applied.append(f"Restarted {', '.join(stopped)} service(s)")
                 except subprocess.CalledProcessError:
-                    issues_found.append(f"Failed to restart {smb_service}")
-        except subprocess.CalledProcessError:
-            issues_found.append(f"Cannot check {smb_service} status")
+                    issues_found.append(f"Failed to restart {', '.join(stopped)}")
+                run_query.cache_clear()
         
         # Configure firewall
         if not self.configure_firewall():
@@ -1158,9 +2059,12 @@ class SMBServerSetup:
         else:
             fixes_applied.append("Configured SELinux for Samba")
         
-        # Test connectivity
-        if self.verify_smb_connectivity():
+        # Test connectivity (None means the test was skipped)
+        connected = self.verify_smb_connectivity()
+        if connected:
             fixes_applied.append("SMB connectivity verified")
+        elif connected is None:
+            skipped_checks.append("SMB connectivity test (dry run)")
         else:
             issues_found.append("SMB connectivity test failed")
         
@@ -1173,6 +2077,11 @@ class SMBServerSetup:
             for fix in fixes_applied:
                 print(f"  • {fix}")
         
+        if skipped_checks:
+            print("⏭️  Skipped Checks:")
+            for check in skipped_checks:
+                print(f"  • {check}")
+        
         if issues_found:
             print("\n⚠️  Issues Found:")
             for issue in issues_found:
@@ -1181,8 +2090,8 @@ class SMBServerSetup:
             print("\n💡 Manual Steps You May Need:")
             print("  • Check Windows Firewall settings")
             print("  • Ensure Windows and Linux are on same network")
-            print(f"  • Try connecting with: \\\\<SERVER_IP>\\{self.share_name}")
-            print(f"  • On Windows, try: net use * \\\\<SERVER_IP>\\{self.share_name}")
+            print(f"  • Try connecting with: {self.share_unc_hint}")
+            print(f"  • On Windows, try: net use * {self.share_unc_hint}")
         else:
             print("\n🎉 All connectivity checks passed!")
         
@@ -1193,48 +2102,41 @@ class SMBServerSetup:
         print("🔍 Enabling verbose Samba logging...")
         
         # Update smb.conf with debug logging
-        debug_config = """
-# Debug logging configuration
-    log level = 3
-    debug timestamp = yes
-    debug uid = yes
-    debug pid = yes
-"""
+        debug_config = "\n# Debug logging configuration\n    log level = 3" + _DEBUG_LOG_OPTIONS + "\n"
         
         try:
             # Read current config
             with open(self.samba_config, 'r') as f:
                 config_content = f.read()
             
-            # Replace log level if it exists, otherwise add debug section
-            if "log level =" in config_content:
-                # Replace existing log level
-                import re
-                config_content = re.sub(r'log level = \d+', 'log level = 3', config_content)
-                # Add debug options if not present
-                if "debug timestamp" not in config_content:
-                    config_content = config_content.replace(
-                        "log level = 3",
-                        "log level = 3\n    debug timestamp = yes\n    debug uid = yes\n    debug pid = yes"
-                    )
-            else:
-                # Add debug section to global section
-                config_content = config_content.replace(
-                    "[global]",
-                    f"[global]{debug_config}"
-                )
+            # Replace log level if it exists (adding debug options if not present),
+            # otherwise add debug section to global section
+            level_line = "log level = 3"
+            if "debug timestamp" not in config_content:
+                level_line += _DEBUG_LOG_OPTIONS
+            new_content, replaced = _LOG_LEVEL_RE.subn(lambda m: level_line, config_content)
+            if not replaced:
+                new_content = config_content.replace("[global]", f"[global]{debug_config}", 1)
+            
+            # Nothing to write or restart if debug logging is already set up
+            if new_content == config_content:
+                print("ℹ️  Verbose logging already enabled")
+                return
             
             # Write updated config
-            with open(self.samba_config, 'w') as f:
-                f.write(config_content)
+            if self.dry_run:
+                print(f"ℹ️  Dry run: would write debug logging settings to {self.samba_config}")
+            else:
+                with open(self.samba_config, 'w') as f:
+                    f.write(new_content)
             
             print("✅ Verbose logging enabled")
             
             # Restart services to apply logging changes
             smb_service, nmb_service = self.get_samba_service_names()
-            subprocess.run(["systemctl", "restart", smb_service], check=True)
-            if nmb_service:
-                subprocess.run(["systemctl", "restart", nmb_service], check=True)
+            units = [smb_service] + ([nmb_service] if nmb_service else [])
+            self._sh(["systemctl", "restart"] + units)
+            run_query.cache_clear()
             
             print("✅ Samba services restarted with verbose logging")
             
@@ -1248,32 +2150,31 @@ class SMBServerSetup:
         print("⏹️  Press Ctrl+C to stop monitoring early")
         print("-" * 60)
         
+        watcher = None
         try:
-            # Monitor main Samba log
-            process = subprocess.Popen(
-                ["tail", "-f", "/var/log/samba/log.smbd"],
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                text=True
-            )
-            
-            start_time = time.time()
-            while time.time() - start_time < duration:
-                try:
-                    # Use select to check if data is available
-                    if hasattr(select, 'select'):
-                        ready, _, _ = select.select([process.stdout], [], [], 1)
-                        if ready:
-                            line = process.stdout.readline()
-                            if line:
-                                timestamp = datetime.datetime.now().strftime("%H:%M:%S")
-                                print(f"[{timestamp}] {line.strip()}")
-                    else:
-                        time.sleep(1)
-                except select.error:
-                    break
+            # Monitor main Samba log, starting at its current end
+            log = open("/var/log/samba/log.smbd", 'r', errors='replace')
+            with log:
+                log.seek(0, os.SEEK_END)
+                watcher = _FileWatcher(log.name)
+                pending = ""
+                
+                deadline = time.monotonic() + duration
+                while True:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    # Sleep until the log is written to (or the time is up)
+                    if not watcher.wait(remaining):
+                        continue
+                    for chunk in iter(log.readline, ''):
+                        pending += chunk
+                        if not pending.endswith('\n'):
+                            continue  # Wait for the rest of the line
+                        timestamp = datetime.datetime.now().strftime("%H:%M:%S")
+                        print(f"[{timestamp}] {pending.strip()}")
+                        pending = ""
             
-            process.terminate()
             print("\n📊 Log monitoring completed")
             
         except FileNotFoundError:
@@ -1287,15 +2188,17 @@ class SMBServerSetup:
             for log_file in alt_logs:
                 if os.path.exists(log_file):
                     print(f"📄 Found log at: {log_file}")
-                    subprocess.run(["tail", "-n", "20", log_file])
+                    print(tail_lines(log_file, 20), end="")
                     break
             else:
                 print("❌ No Samba log files found")
         
         except KeyboardInterrupt:
             print("\n⏹️  Log monitoring stopped by user")
-            if 'process' in locals():
-                process.terminate()
+        
+        finally:
+            if watcher is not None:
+                watcher.close()
     
     def check_network_connectivity(self):
         """Perform comprehensive network connectivity checks"""
@@ -1316,34 +2219,46 @@ class SMBServerSetup:
         bind_ip = self.bind_interfaces
         print(f"\n🔗 Checking binding interface: {bind_ip}")
         
-        # Check if the specific IP is reachable
-        try:
-            result = subprocess.run(["ping", "-c", "1", "-W", "2", bind_ip], 
-                                  capture_output=True, text=True)
-            if result.returncode == 0:
-                print(f"✅ Binding IP {bind_ip} is reachable")
-            else:
-                print(f"⚠️  Binding IP {bind_ip} may not be reachable")
-        except subprocess.CalledProcessError:
+        # Check if the specific IP accepts SMB connections
+        reachable = None
+        if bind_ip is not None:
+            try:
+                with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as probe:
+                    probe.settimeout(1.0)
+                    reachable = probe.connect_ex((bind_ip, 445)) == 0
+            except OSError:
+                pass
+        if reachable is None:
             print(f"⚠️  Cannot test binding IP {bind_ip}")
+        elif reachable:
+            print(f"✅ Binding IP {bind_ip} is reachable on port 445")
+        else:
+            print(f"⚠️  Binding IP {bind_ip} may not be reachable on port 445")
         
         # Check SMB ports
         print("\n🔌 Checking SMB port status:")
         ports_to_check = [445, 139]
         
+        # List listening sockets once and filter per port in Python
+        try:
+            ss_lines = subprocess.run(["ss", "-tlnp"], capture_output=True,
+                                      text=True, check=True).stdout.splitlines()
+        except (subprocess.CalledProcessError, FileNotFoundError):
+            ss_lines = None
+        
         for port in ports_to_check:
-            try:
-                # Check specific IP
-                result = subprocess.run(["ss", "-tlnp", f"| grep {bind_ip}:{port}"], 
-                                      shell=True, capture_output=True, text=True)
-                
-                if result.stdout.strip():
-                    print(f"  ✅ Port {port}: LISTENING")
-                    print(f"     {result.stdout.strip()}")
-                else:
-                    print(f"  ❌ Port {port}: NOT LISTENING")
-            except subprocess.CalledProcessError:
+            if ss_lines is None:
                 print(f"  ⚠️  Port {port}: Cannot check")
+                continue
+            
+            # Check specific IP
+            matches = [line for line in ss_lines if f"{bind_ip}:{port}" in line]
+            if matches:
+                print(f"  ✅ Port {port}: LISTENING")
+                for line in matches:
+                    print(f"     {line.strip()}")
+            else:
+                print(f"  ❌ Port {port}: NOT LISTENING")
         
         # Check routing
         print("\n🛣️  Network Routing Information:")
@@ -1364,6 +2279,32 @@ class SMBServerSetup:
         
         report_file = f"/tmp/samba_debug_report_{int(time.time())}.txt"
         
+        log_files = [log_file for log_file in ("/var/log/samba/log.smbd", "/var/log/samba/log.nmbd")
+                     if os.path.exists(log_file)]
+        
+        # The report commands are independent, so run them all concurrently
+        commands = {
+            "uname": ["uname", "-a"],
+            "testparm": ["testparm", "-s"],
+            "ip": ["ip", "addr", "show"],
+            "ss": ["ss", "-tlnp"],
+            "firewall": ["firewall-cmd", "--list-all"],
+        }
+        
+        with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+            futures = {key: executor.submit(self._run_report_command, argv)
+                       for key, argv in commands.items()}
+            # Resolve the service names while the commands above are running
+            smb_service, nmb_service = self.get_samba_service_names()
+            services = [service for service in (smb_service, nmb_service) if service]
+            for service in services:
+                futures[f"status:{service}"] = executor.submit(
+                    self._run_report_command, ["systemctl", "status", service])
+            results = {key: future.result() for key, future in futures.items()}
+        
+        def succeeded(key):
+            return results[key] is not None and results[key].returncode == 0
+        
         with open(report_file, 'w') as f:
             f.write("SAMBA DEBUG REPORT\n")
             f.write("=" * 50 + "\n")
@@ -1372,77 +2313,67 @@ class SMBServerSetup:
             # System information
             f.write("SYSTEM INFORMATION:\n")
             f.write("-" * 20 + "\n")
-            try:
-                result = subprocess.run(["uname", "-a"], capture_output=True, text=True, check=True)
-                f.write(f"System: {result.stdout}")
-            except subprocess.CalledProcessError:
+            if succeeded("uname"):
+                f.write(f"System: {results['uname'].stdout}")
+            else:
                 f.write("System: Unknown\n")
             
             # Samba configuration
             f.write("\nSAMBA CONFIGURATION:\n")
             f.write("-" * 20 + "\n")
-            try:
-                result = subprocess.run(["testparm", "-s"], capture_output=True, text=True, check=True)
-                f.write(result.stdout)
-            except subprocess.CalledProcessError as e:
-                f.write(f"Configuration test failed: {e}\n")
+            if succeeded("testparm"):
+                f.write(results["testparm"].stdout)
+            elif results["testparm"] is not None:
+                f.write(f"Configuration test failed: exit status {results['testparm'].returncode}\n")
+            else:
+                f.write("Configuration test failed: testparm not found\n")
             
             # Service status
             f.write("\nSERVICE STATUS:\n")
             f.write("-" * 15 + "\n")
-            smb_service, nmb_service = self.get_samba_service_names()
-            for service in [smb_service, nmb_service]:
-                if service:
-                    try:
-                        result = subprocess.run(["systemctl", "status", service], 
-                                              capture_output=True, text=True)
-                        f.write(f"{service} status:\n{result.stdout}\n\n")
-                    except subprocess.CalledProcessError:
-                        f.write(f"{service}: Cannot get status\n")
+            for service in services:
+                result = results[f"status:{service}"]
+                if result is not None:
+                    f.write(f"{service} status:\n{result.stdout}\n\n")
+                else:
+                    f.write(f"{service}: Cannot get status\n")
             
             # Network information
             f.write("NETWORK INFORMATION:\n")
             f.write("-" * 20 + "\n")
-            try:
-                result = subprocess.run(["ip", "addr", "show"], capture_output=True, text=True, check=True)
-                f.write(result.stdout)
-            except subprocess.CalledProcessError:
+            if succeeded("ip"):
+                f.write(results["ip"].stdout)
+            else:
                 f.write("Cannot get network information\n")
             
             # Port status
             f.write("\nPORT STATUS:\n")
             f.write("-" * 12 + "\n")
-            try:
-                result = subprocess.run(["ss", "-tlnp"], capture_output=True, text=True, check=True)
+            if succeeded("ss"):
                 # Filter SMB-related ports
-                for line in result.stdout.split('\n'):
-                    if any(port in line for port in [':445', ':139', ':137', ':138']):
+                for line in results["ss"].stdout.split('\n'):
+                    if _SMB_PORT_RE.search(line):
                         f.write(f"{line}\n")
-            except subprocess.CalledProcessError:
+            else:
                 f.write("Cannot get port information\n")
             
             # Firewall status
             f.write("\nFIREWALL STATUS:\n")
             f.write("-" * 16 + "\n")
-            try:
-                result = subprocess.run(["firewall-cmd", "--list-all"], capture_output=True, text=True, check=True)
-                f.write(result.stdout)
-            except subprocess.CalledProcessError:
+            if succeeded("firewall"):
+                f.write(results["firewall"].stdout)
+            else:
                 f.write("Cannot get firewall status (firewalld not available)\n")
             
             # Recent Samba logs
             f.write("\nRECENT SAMBA LOGS:\n")
             f.write("-" * 18 + "\n")
-            log_files = ["/var/log/samba/log.smbd", "/var/log/samba/log.nmbd"]
             for log_file in log_files:
-                if os.path.exists(log_file):
-                    f.write(f"\n{log_file}:\n")
-                    try:
-                        result = subprocess.run(["tail", "-n", "50", log_file], 
-                                              capture_output=True, text=True, check=True)
-                        f.write(result.stdout)
-                    except subprocess.CalledProcessError:
-                        f.write("Cannot read log file\n")
+                f.write(f"\n{log_file}:\n")
+                try:
+                    f.write(tail_lines(log_file, 50))
+                except OSError:
+                    f.write("Cannot read log file\n")
         
         print(f"📄 Debug report saved to: {report_file}")
         print("📤 You can share this file for detailed troubleshooting")
@@ -1453,6 +2384,13 @@ class SMBServerSetup:
         
         return report_file
     
+    def _run_report_command(self, argv):
+        """Run a read-only diagnostic command, returning None if it is not installed"""
+        try:
+            return subprocess.run(argv, capture_output=True, text=True)
+        except FileNotFoundError:
+            return None
+    
     def start_debug_session(self):
         """Start interactive debug session"""
         print("\n🔧 Starting Debug Session")
@@ -1471,10 +2409,10 @@ class SMBServerSetup:
         
         while True:
             try:
-                choice = input("\n🔍 Select debug option (1-5): ").strip()
+                choice = self._read_line("\n🔍 Select debug option (1-5): ").strip()
                 
                 if choice == "1":
-                    duration = input("Monitor duration in seconds (default 60): ").strip()
+                    duration = self._read_line("Monitor duration in seconds (default 60): ").strip()
                     try:
                         duration = int(duration) if duration else 60
                     except ValueError:
@@ -1504,34 +2442,79 @@ class SMBServerSetup:
                 print("\n\n👋 Debug session ended")
                 break
 
+    def _build_messages(self):
+        """Format the connection info and post-setup reminder blocks once"""
+        primary_ip = self.bind_interfaces
+        share_name = self.share_name
+        units = " ".join(unit for unit in self.get_samba_service_names() if unit)
+        connection = [
+            "\n" + "="*60,
+            "🎉 SMB SERVER SETUP COMPLETE!",
+            "="*60,
+            f"🔗 Binding Interface: {self.bind_interface_name} ({primary_ip})",
+            f"📡 Server IP Address: {primary_ip}",
+            f"📁 Share Name: {share_name}",
+            f"📂 Share Path: {self.share_path}",
+            "\n🪟 Windows Connection Instructions:",
+            "1. Open File Explorer on Windows",
+            "2. In the address bar, type:",
+            f"   \\\\{primary_ip}\\{share_name}",
+            "3. Press Enter",
+            "4. No username/password required (anonymous access)",
+            "\n🔧 Management Commands:",
+            f"• Check service status: sudo systemctl status {units}",
+            f"• Restart Samba: sudo systemctl restart {units}",
+            "• View logs: sudo tail -f /var/log/samba/log.smbd",
+            "• Test config: sudo testparm",
+            "\n⚠️  Security Note:",
+            "This setup allows anonymous access to the shared directory.",
+            "Ensure this is appropriate for your network environment.",
+        ]
+        if self.multichannel:
+            connection += [
+                "\n🔀 Multi-channel Note:",
+                "Enable it on the Windows client too (PowerShell as Admin):",
+                "   Set-SmbClientConfiguration -EnableMultiChannel $true",
+            ]
+        reminders = [
+            "\n📋 IMPORTANT POST-SETUP REMINDERS:",
+            "=" * 50,
+            "🔥 FIREWALL: If SMB share is not accessible from guest OS:",
+            "   • Check if your network interface is in libvirt zone:",
+            "     sudo firewall-cmd --get-zone-of-interface=virbr55",
+            "   • If yes, add Samba to libvirt zone:",
+            f"     sudo firewall-cmd --zone=libvirt {' '.join(SAMBA_FIREWALLD_ARGS)}",
+            "     sudo firewall-cmd --runtime-to-permanent",
+            "     (this overwrites unapplied --permanent edits; if you have any, repeat",
+            "      the previous command with --permanent instead)",
+            "🪟 WINDOWS: If Windows can't connect, enable SMB1 client:",
+            "   • PowerShell as Admin: Enable-WindowsOptionalFeature -Online -FeatureName SMB1Protocol-Client",
+            "   • Or: Control Panel → Programs → Turn Windows features on/off → SMB 1.0/CIFS File Sharing Support",
+            f"🔁 SERVICES: Pass both units in one call: sudo systemctl restart {units}",
+            "🔍 DEBUGGING: Use --debug flag for detailed troubleshooting",
+            "",
+        ]
+        debug_info = [
+            "\n🐛 DEBUG MODE - Additional Information:",
+            "=" * 50,
+            "🔍 Use the following commands to monitor connections:",
+            "  • Monitor logs: sudo tail -f /var/log/samba/log.smbd",
+            "  • Monitor connections: sudo python3 main.py --monitor",
+            "  • Generate report: sudo python3 main.py --report",
+            "  • Start debug session: sudo python3 main.py --debug",
+        ]
+        self._msgs = {
+            "connection": "\n".join(connection) + "\n",
+            "reminders": "\n".join(reminders) + "\n",
+            "debug": "\n".join(debug_info) + "\n",
+        }
+        return self._msgs
+
     def show_connection_info(self):
         """Display connection information for Windows client"""
-        print("\n" + "="*60)
-        print("🎉 SMB SERVER SETUP COMPLETE!")
-        print("="*60)
-
-        # Display binding information
-        print(f"🔗 Binding Interface: {self.bind_interface_name} ({self.bind_interfaces})")
-        
-        # Get server IP address
-        primary_ip = self.bind_interfaces
-        print(f"📡 Server IP Address: {primary_ip}")
-        print(f"📁 Share Name: {self.share_name}")
-        print(f"📂 Share Path: {self.share_path}")
-        print("\n🪟 Windows Connection Instructions:")
-        print("1. Open File Explorer on Windows")
-        print("2. In the address bar, type:")
-        print(f"   \\\\{primary_ip}\\{self.share_name}")
-        print("3. Press Enter")
-        print("4. No username/password required (anonymous access)")
-        print("\n🔧 Management Commands:")
-        print("• Check service status: sudo systemctl status smbd")
-        print("• Restart Samba: sudo systemctl restart smbd nmbd")
-        print("• View logs: sudo tail -f /var/log/samba/log.smbd")
-        print("• Test config: sudo testparm")
-        print("\n⚠️  Security Note:")
-        print("This setup allows anonymous access to the shared directory.")
-        print("Ensure this is appropriate for your network environment.")
+        msgs = self._msgs or self._build_messages()
+        sys.stdout.write(msgs["connection"])
+        sys.stdout.flush()
 
     def setup(self):
         """Main setup function"""
@@ -1543,16 +2526,48 @@ class SMBServerSetup:
         print()
 
         self.check_root_privileges()
-        self.check_share_directory()
+
+        with _ThreadOutputBuffer() as output, \
+                concurrent.futures.ThreadPoolExecutor(max_workers=3) as executor:
+            # Warm the probe caches while the share directory is checked
+            prefetch = [executor.submit(output.run, self.detect_os),
+                        executor.submit(output.run, self.get_network_interfaces),
+                        executor.submit(output.run, self.get_nobody_user_group)]
+            self.check_share_directory()
+            for future in prefetch:
+                future.result()
+
         self.select_network_binding()
         self.select_smb_version()
-        self.install_samba()
-        self.backup_samba_config()
-        self.create_samba_config()
-        self.set_directory_permissions()
+
+        if self._already_configured():
+            print("✅ Already configured: Samba is running with these settings "
+                  "(use --force to run every step again)")
+            self.show_connection_info()
+            return
+
+        with _ThreadOutputBuffer() as output, \
+                concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+            # SELinux booleans don't depend on the Samba package, so set them
+            # while it is being installed
+            selinux_step = executor.submit(output.run, self.configure_selinux)
+            self.install_samba()
+            selinux_step.result()
+
+        # The ufw "samba" application profile ships with the samba package
         self.configure_firewall()
-        self.configure_selinux()
-        self.test_configuration()
+
+        with _ThreadOutputBuffer() as output, \
+                concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+            # Service names can only be probed once Samba is installed
+            service_names = executor.submit(output.run, self.get_samba_service_names)
+            self.backup_samba_config()
+            nobody_user, nobody_group = self.get_nobody_user_group()
+            self.create_samba_config(nobody_user, nobody_group)
+            self.set_directory_permissions(nobody_user, nobody_group)
+            self.test_configuration()
+            service_names.result()
+
         self.start_samba_services()
         
         # Run troubleshooting to ensure everything works
@@ -1561,47 +2576,30 @@ class SMBServerSetup:
         # Check firewall status and show reminders
         self.check_firewall_status()
         
+        # Let the next run with the same settings skip straight to the summary
+        self._save_state()
+        
         # Enable verbose logging if debug mode
         if self.debug_mode:
             self.enable_verbose_logging()
         
         self.show_connection_info()
         
-        # Important reminders
-        print("\n📋 IMPORTANT POST-SETUP REMINDERS:")
-        print("=" * 50)
-        print("🔥 FIREWALL: If SMB share is not accessible from guest OS:")
-        print("   • Check if your network interface is in libvirt zone:")
-        print("     sudo firewall-cmd --get-zone-of-interface=virbr55")
-        print("   • If yes, add Samba to libvirt zone:")
-        print("     sudo firewall-cmd --zone=libvirt --add-service=samba --permanent")
-        print("     sudo firewall-cmd --zone=libvirt --add-port=445/tcp --permanent")
-        print("     sudo firewall-cmd --zone=libvirt --add-port=139/tcp --permanent")
-        print("     sudo firewall-cmd --reload")
-        print("🪟 WINDOWS: If Windows can't connect, enable SMB1 client:")
-        print("   • PowerShell as Admin: Enable-WindowsOptionalFeature -Online -FeatureName SMB1Protocol-Client")
-        print("   • Or: Control Panel → Programs → Turn Windows features on/off → SMB 1.0/CIFS File Sharing Support")
-        print("🔍 DEBUGGING: Use --debug flag for detailed troubleshooting")
-        print()
+        # Important reminders, plus additional debug info in debug mode
+        msgs = self._msgs or self._build_messages()
+        if self.debug_mode:
+            sys.stdout.write(msgs["reminders"] + msgs["debug"])
+        else:
+            sys.stdout.write(msgs["reminders"])
+        sys.stdout.flush()
         
-        # Additional debug info in debug mode
         if self.debug_mode:
-            print("\n🐛 DEBUG MODE - Additional Information:")
-            print("=" * 50)
-            print("🔍 Use the following commands to monitor connections:")
-            print("  • Monitor logs: sudo tail -f /var/log/samba/log.smbd")
-            print("  • Monitor connections: sudo python3 main.py --monitor") 
-            print("  • Generate report: sudo python3 main.py --report")
-            print("  • Start debug session: sudo python3 main.py --debug")
-            
             # Show current network and port status
             self.check_network_connectivity()
 
 
 def main():
     """Main function"""
-    import argparse
-    
     parser = argparse.ArgumentParser(description="SMB Server Setup Script")
     parser.add_argument("--debug", action="store_true", 
                        help="Enable debug mode with verbose logging and monitoring")
@@ -1609,12 +2607,59 @@ def main():
                        help="Start log monitoring session")
     parser.add_argument("--report", action="store_true",
                        help="Generate debug report only")
+    parser.add_argument("--force-refresh", action="store_true",
+                       help="Always refresh the package index before installing Samba "
+                            "and discard cached probe results")
+    parser.add_argument("--force", action="store_true",
+                       help="Run every setup step even if a previous run already "
+                            "configured Samba with the same settings")
+    parser.add_argument("--no-cache", action="store_true",
+                       help="Do not reuse probe results cached by previous runs")
+    parser.add_argument("-y", "--yes", action="store_true",
+                       help="Non-interactive: skip prompts and use the default choices")
+    parser.add_argument("--interface",
+                       help="Bind to this interface (name or IPv4 address) without prompting")
+    parser.add_argument("--smb-min", choices=SMB_PROTOCOLS,
+                       help="Minimum SMB protocol (skips the protocol prompt)")
+    parser.add_argument("--smb-max", choices=SMB_PROTOCOLS,
+                       help="Maximum SMB protocol (skips the protocol prompt)")
+    parser.add_argument("--share-path",
+                       help=f"Directory to share (default: {NETWORK_PATH})")
+    parser.add_argument("--dry-run", action="store_true",
+                       help="Show the commands and file changes setup would make without applying them")
+    parser.add_argument("--multichannel", action="store_true",
+                       help="Enable SMB3 multi-channel (one session over several TCP connections)")
+    parser.add_argument("--tune-large-buffers", action="store_true",
+                       help="Use 16 MiB socket buffers for high-throughput links "
+                            "(not recommended on low-memory hosts)")
     
     args = parser.parse_args()
     
+    if (args.smb_min and args.smb_max and
+            SMB_PROTOCOLS.index(args.smb_min) > SMB_PROTOCOLS.index(args.smb_max)):
+        parser.error("--smb-min must not be newer than --smb-max")
+    
     try:
-        setup = SMBServerSetup()
+        setup = SMBServerSetup(share_path=args.share_path)
         setup.debug_mode = args.debug
+        setup.force_refresh = args.force_refresh
+        setup.force = args.force
+        setup.use_probe_cache = not args.no_cache
+        setup.assume_yes = args.yes
+        setup.requested_interface = args.interface
+        if args.smb_min or args.smb_max:
+            setup.smb_min_protocol = args.smb_min or setup.smb_min_protocol
+            setup.smb_max_protocol = args.smb_max or setup.smb_max_protocol
+            setup.smb_protocols_fixed = True
+        setup.multichannel = args.multichannel
+        setup.dry_run = args.dry_run
+        if args.tune_large_buffers:
+            setup.socket_buffer_size = SMB_LARGE_SOCKET_BUFFER
+        if args.force_refresh and args.dry_run:
+            # Probe afresh without deleting the cache file
+            setup.use_probe_cache = False
+        elif args.force_refresh:
+            clear_probe_cache()
         
         if args.report:
             # Generate debug report only